@@ -3,6 +3,7 @@
 import sys
 import asyncio
 import json
+import struct
 import websockets
 import argparse
 
@@ -12,43 +13,114 @@ import numpy as np
 from ctypes import *
 import darknet
 
-def detect_image(network, class_names, image, thresh=.5, hier_thresh=.5, nms=.45):
+# Binary result format, a header with the number of detections followed by one packed record per detection
+RESULT_MAGIC = b'SBD1'
+RESULT_HEADER = struct.Struct('<4sI')
+RESULT_RECORD = np.dtype([('cls', '<i4'), ('conf', '<f4'), ('box', '<f4', (4,))])
+
+class DarknetImagePool():
+    # Darknet images kept for the life of the server, one per size, instead of a make_image and free_image per frame
+    def __init__(self):
+        self.images = {}
+
+    def get(self, width, height):
+        key = (width, height)
+        if not key in self.images:
+            image = darknet.make_image(width, height, 3)
+
+            # Channel, row, column float view onto the darknet image buffer so pixels can be written straight into it
+            pixels = np.ctypeslib.as_array(image.data, shape=(3, height, width))
+            self.images[key] = (image, pixels)
+
+        return self.images[key]
+
+def collect_predictions(detections, class_names, num, class_ids):
+    # remove_negatives for only the classes the client wants instead of every class
+    predictions = []
+    for j in range(num):
+        for idx in class_ids:
+            if detections[j].prob[idx] > 0:
+                bbox = detections[j].bbox
+                predictions.append((class_names[idx], detections[j].prob[idx], (bbox.x, bbox.y, bbox.w, bbox.h)))
+    return predictions
+
+def detect_image(network, class_names, image, width, height, thresh=.5, hier_thresh=.5, nms=.45, class_ids=None):
     pnum = pointer(c_int(0))
     darknet.predict_image(network, image)
-    detections = darknet.get_network_boxes(network, image.w, image.h,
+    # Boxes come back scaled to the original frame size rather than the network sized image
+    detections = darknet.get_network_boxes(network, width, height,
                                    thresh, hier_thresh, None, 0, pnum, 0)
     num = pnum[0]
     if nms:
         darknet.do_nms_sort(detections, num, len(class_names), nms)
-    predictions = darknet.remove_negatives(detections, class_names, num)
+    if class_ids is None:
+        predictions = darknet.remove_negatives(detections, class_names, num)
+    else:
+        predictions = collect_predictions(detections, class_names, num, class_ids)
     darknet.free_detections(detections, num)
     return sorted(predictions, key=lambda x: x[1])
 
-def detect(network, class_names, image_bytes, thresh=.5):
-    darknet_image = darknet.make_image(image_bytes.shape[1], image_bytes.shape[0], 3)
+def detect(network, class_names, frame, thresh=.5, class_ids=None):
+    height, width = frame.shape[:2]
+    darknet_image, pixels = image_pool.get(network_width, network_height)
 
-    image_rgb = cv2.cvtColor(image_bytes, cv2.COLOR_BGR2RGB)
+    # Resize first so the conversion only touches network sized images
+    resized = cv2.resize(frame, (network_width, network_height), interpolation=cv2.INTER_LINEAR)
 
-    darknet.copy_image_from_bytes(darknet_image, image_rgb.tobytes())
+    # BGR rows of pixels to RGB planes scaled to 0..1, the same conversion copy_image_from_bytes does,
+    # written directly into the darknet image
+    np.divide(resized.transpose(2, 0, 1)[::-1], 255.0, out=pixels, casting='unsafe')
 
-    detections = detect_image(network, class_names, darknet_image, thresh=thresh)
-    darknet.free_image(darknet_image)
-    return detections
+    return detect_image(network, class_names, darknet_image, width, height, thresh=thresh, class_ids=class_ids)
+
+def result_binary(rlist):
+    records = np.empty(len(rlist), dtype=RESULT_RECORD)
+    for i, (name, prob, bbox) in enumerate(rlist):
+        records[i] = (class_index[name], prob, bbox)
+    return RESULT_HEADER.pack(RESULT_MAGIC, len(records)) + records.tobytes()
+
+def hello_reply(message):
+    # Clients ask for the result format and the classes they want once per connection, the class names
+    # are sent with the answer so binary results only need to carry class ids
+    try:
+        hello = json.loads(message)['hello']
+    except Exception:
+        hello = {}
+
+    resultFormat = "json"
+    if hello.get('format') == "binary":
+        resultFormat = "binary"
+
+    class_ids = None
+    if hello.get('classes') is not None:
+        class_ids = sorted(set(class_index[name] for name in hello['classes'] if name in class_index))
+
+    return {"format": resultFormat, "names": list(class_names)}, class_ids
 
 async def server_me(websocket, path):
+    binary = False
+    class_ids = None
+
     while True:
         try:
             blob_data = await websocket.recv()
         except websockets.ConnectionClosed:
             break
 
+        if isinstance(blob_data, str):
+            # Text messages are the handshake, frames are always sent as binary messages
+            reply, class_ids = hello_reply(blob_data)
+            binary = reply['format'] == "binary"
+            await websocket.send(json.dumps(reply))
+            continue
+
         new_rlist = []
 
         try:
             nparr = np.frombuffer(blob_data, np.uint8)
             frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
-            r = detect(net, class_names, frame)
+            r = detect(net, class_names, frame, class_ids=class_ids)
 
             r_list = [list(i) for i in r]
             for piece in r_list:
@@ -60,7 +132,10 @@ async def server_me(websocket, path):
             print("{0}".format(new_rlist))
             print()
 
-        await websocket.send(json.dumps(new_rlist))
+        if binary:
+            await websocket.send(result_binary(new_rlist))
+        else:
+            await websocket.send(json.dumps(new_rlist))
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-b", "--bind", dest="bind_address", help="Bind address for the server")
@@ -77,6 +152,10 @@ server_port = args.server_port
 debug = args.debug
 
 net, class_names, class_colors = darknet.load_network("cfg/sbts-yolov3.cfg", "cfg/coco.data", "yolov3.weights", batch_size=1)
+network_width = darknet.network_width(net)
+network_height = darknet.network_height(net)
+image_pool = DarknetImagePool()
+class_index = {name: i for i, name in enumerate(class_names)}
 
 start_server = websockets.serve(server_me, server_bind_address, server_port)
 
@@ -0,0 +1,128 @@
+# Copyright, 2026, Kim Hendrikse
+
+import bisect
+
+# Seconds, from a fast model round trip up to a notification endpoint that is timing out
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatLabels(labelNames, labelValues, extra=None):
+    pairs = ['{}="{}"'.format(name, escapeLabel(value)) for name, value in zip(labelNames, labelValues)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(extra[0], escapeLabel(extra[1])))
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+class Registry():
+    # The metrics rendered together in the Prometheus text format
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> 'str':
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+# A count that only goes up per combination of label values, only call it from the event loop thread
+class Counter():
+    type = "counter"
+
+    def __init__(self, name, help, labelNames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.values = {}
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, labelValues=(), amount=1):
+        self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def get(self, labelValues=()):
+        return self.values.get(labelValues, 0)
+
+    def render(self) -> 'list':
+        return ["{}{} {}".format(self.name, formatLabels(self.labelNames, labelValues), value)
+                for labelValues, value in self.values.items()]
+
+class Histogram():
+    # Observations counted into fixed buckets, plus their sum and count
+    type = "histogram"
+
+    def __init__(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value, labelValues=()):
+        series = self.values.get(labelValues)
+        if series is None:
+            # Counts per bucket with the last one for everything above the highest bucket, sum, count
+            series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self.values[labelValues] = series
+
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def quantile(self, q, labelValues=()):
+        # The upper bound of the bucket the quantile falls in, None above the highest bucket
+        counts, total, count = self.values[labelValues]
+        target = q * count
+        cumulative = 0
+        for bound, bucketCount in zip(self.buckets, counts):
+            cumulative += bucketCount
+            if cumulative >= target:
+                return bound
+        return None
+
+    def summary(self) -> 'dict':
+        summaryMap = {}
+        for labelValues, (counts, total, count) in self.values.items():
+            summaryMap[labelValues] = {"count": count,
+                                       "mean": total / count,
+                                       "p50": self.quantile(0.5, labelValues),
+                                       "p95": self.quantile(0.95, labelValues)}
+        return summaryMap
+
+    def render(self) -> 'list':
+        lines = []
+        for labelValues, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucketCount
+                lines.append("{}_bucket{} {}".format(self.name, formatLabels(self.labelNames, labelValues, ("le", bound)), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, formatLabels(self.labelNames, labelValues), total))
+            lines.append("{}_count{} {}".format(self.name, formatLabels(self.labelNames, labelValues), count))
+        return lines
+
+# A counter or gauge read from counts kept elsewhere when the metrics are rendered
+class Collected():
+    def __init__(self, name, help, type, labelNames, function, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelNames = labelNames
+        self.function = function
+        if registry is not None:
+            registry.register(self)
+
+    def render(self) -> 'list':
+        return ["{}{} {}".format(self.name, formatLabels(self.labelNames, labelValues), value)
+                for labelValues, value in self.function().items()]
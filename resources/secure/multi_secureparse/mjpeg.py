@@ -0,0 +1,178 @@
+# Copyright, 2026, Kim Hendrikse
+
+JPEG_START = b'\xff\xd8'
+JPEG_END = b'\xff\xd9'
+HEADER_END = b'\r\n\r\n'
+
+# Give up on a frame that grows beyond this, the stream has lost sync
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Incremental MJPEG parser, cuts frames by part Content-Length when given and by JPEG markers otherwise
+class MjpegParser():
+    def __init__(self, boundary:bytes = None, maxFrameSize:int = MAX_FRAME_SIZE):
+        self.boundary = boundary
+        self.maxFrameSize = maxFrameSize
+        self.buffer = bytearray()
+        self.useLength = boundary is not None
+        self.scanPos = 0
+        self.frameStart = -1
+        self.bodyStart = -1
+        self.contentLength = None
+
+    @classmethod
+    def from_content_type(cls, contentType:str, maxFrameSize:int = MAX_FRAME_SIZE) -> 'MjpegParser':
+        boundary = None
+        if contentType is not None and contentType.strip().lower().startswith('multipart/'):
+            for param in contentType.split(';')[1:]:
+                key, sep, value = param.strip().partition('=')
+                if key.strip().lower() == 'boundary' and value.strip('" ') != '':
+                    # Cameras disagree on whether the leading -- is part of the boundary, searching
+                    # for the boundary as given matches both forms in the body
+                    boundary = value.strip('" ').encode('latin-1')
+        return cls(boundary=boundary, maxFrameSize=maxFrameSize)
+
+    def feed(self, chunk) -> 'list:bytes':
+        self.buffer += chunk
+
+        frames = []
+        while True:
+            useLength = self.useLength
+            if useLength:
+                frame = self.nextPartByLength()
+            else:
+                frame = self.nextFrameByMarkers()
+
+            if frame is not None:
+                frames.append(frame)
+            elif useLength == self.useLength:
+                # Nothing more can be parsed until the next chunk arrives
+                break
+
+        if len(self.buffer) > self.maxFrameSize:
+            self.resync()
+
+        return frames
+
+    def getBufferedSize(self):
+        return len(self.buffer)
+
+    def nextPartByLength(self):
+        if self.contentLength is None:
+            # Looking for the next part header
+            boundaryPos = self.buffer.find(self.boundary, self.scanPos)
+            if boundaryPos == -1:
+                # Keep enough of the tail to match a boundary split over two chunks
+                self.discard(max(0, len(self.buffer) - len(self.boundary) + 1))
+                return None
+
+            headerEnd = self.buffer.find(HEADER_END, boundaryPos)
+            if headerEnd == -1:
+                self.discard(boundaryPos)
+                return None
+
+            headers = bytes(self.buffer[boundaryPos + len(self.boundary):headerEnd])
+            contentLength = self.parseContentLength(headers)
+            if contentLength is None:
+                # No length given, carry on by scanning for the JPEG markers from the part body
+                self.useLength = False
+                self.discard(headerEnd + len(HEADER_END))
+                return None
+
+            self.contentLength = contentLength
+            self.bodyStart = headerEnd + len(HEADER_END)
+
+        bodyEnd = self.bodyStart + self.contentLength
+        if len(self.buffer) < bodyEnd:
+            return None
+
+        if self.buffer.startswith(JPEG_START, self.bodyStart):
+            # Some cameras count the CRLF before the next boundary in the length
+            frameEnd = bodyEnd
+            if self.buffer.endswith(b'\r\n', 0, frameEnd):
+                frameEnd -= 2
+
+            if self.buffer.endswith(JPEG_END, 0, frameEnd):
+                frame = self.extract(self.bodyStart, frameEnd)
+                self.contentLength = None
+                self.discard(bodyEnd)
+                return frame
+
+            # The length is off for this part, cut it at the next boundary instead
+            return self.nextPartByBoundary()
+
+        # The length didn't line up with a JPEG, stop trusting the part headers for this stream
+        self.useLength = False
+        self.contentLength = None
+        self.discard(self.bodyStart)
+        return None
+
+    def nextPartByBoundary(self):
+        nextPart = self.buffer.find(self.boundary, self.bodyStart)
+        if nextPart == -1:
+            # Wait for the next part to know where this one ends
+            return None
+
+        # The last end marker in the part, a thumbnail inside the JPEG has its own
+        end = self.buffer.rfind(JPEG_END, self.bodyStart + len(JPEG_START), nextPart)
+        self.contentLength = None
+        if end == -1:
+            # A JPEG cut short, drop it and carry on with the next part
+            self.discard(nextPart)
+            return self.nextPartByLength()
+
+        frame = self.extract(self.bodyStart, end + len(JPEG_END))
+        self.discard(nextPart)
+        return frame
+
+    def nextFrameByMarkers(self):
+        if self.frameStart == -1:
+            start = self.buffer.find(JPEG_START, self.scanPos)
+            if start == -1:
+                # A marker can be split over two chunks so keep the last byte
+                self.discard(max(0, len(self.buffer) - 1))
+                return None
+            self.discard(start)
+            self.frameStart = 0
+            self.scanPos = len(JPEG_START)
+
+        end = self.buffer.find(JPEG_END, self.scanPos)
+        if end == -1:
+            self.scanPos = max(self.frameStart + len(JPEG_START), len(self.buffer) - 1)
+            return None
+
+        frame = self.extract(self.frameStart, end + len(JPEG_END))
+        self.frameStart = -1
+        self.discard(end + len(JPEG_END))
+        return frame
+
+    def extract(self, start, end) -> 'bytes':
+        # One copy straight out of the buffer
+        with memoryview(self.buffer) as view:
+            return bytes(view[start:end])
+
+    def discard(self, count):
+        # Deleting from the front of a bytearray doesn't move the remaining data in CPython
+        if count > 0:
+            del self.buffer[:count]
+        self.scanPos = 0
+        self.frameStart = -1
+
+    def resync(self):
+        self.buffer = bytearray()
+        self.scanPos = 0
+        self.frameStart = -1
+        self.contentLength = None
+        self.useLength = self.boundary is not None
+
+    @staticmethod
+    def parseContentLength(headers:bytes):
+        for line in headers.split(b'\r\n'):
+            name, sep, value = line.partition(b':')
+            if sep and name.strip().lower() == b'content-length':
+                try:
+                    contentLength = int(value.strip())
+                except ValueError:
+                    return None
+                if contentLength > 0:
+                    return contentLength
+        return None
@@ -1,14 +1,34 @@
 # Copyright, 2021, Kim Hendrikse
 
+import asyncio
 import os
+import aiohttp
 import requests
 import time
 import threading
 from threading import Thread
 
+import numpy as np
 from shapely.geometry import Point
 from shapely.geometry.polygon import Polygon
 
+try:
+    # Shapely 2
+    from shapely import contains_xy, prepare
+except ImportError:
+    from shapely.vectorized import contains as contains_xy
+    prepare = None
+
+from multi_secureparse.mjpeg import MjpegParser
+from multi_secureparse.modelpool import DEFAULT_REPLY_TIMEOUT
+from multi_secureparse.motion import MotionGate
+from multi_secureparse.notifier import DEFAULT_TIMEOUT, DEFAULT_RETRIES
+from multi_secureparse.plan import RulePlan
+from multi_secureparse.protocol import FORMAT_JSON, FORMAT_BINARY
+
+# Bytes read from the camera stream at a time
+DEFAULT_CHUNK_SIZE = 16384
+
 class ModelMap():
     def __init__(self, modelsMap):
         self.modelsMap = modelsMap
@@ -17,7 +37,49 @@ class ModelMap():
     def from_json(cls, modelList) -> 'ModelMap':
         modelsMap = {}
         for key in modelList.keys():
-            modelsMap[key] = {"url":modelList[key]['url']}
+            # Number of requests that may be outstanding on this model server at once
+            maxInFlight = 1
+            if 'maxInFlight' in modelList[key].keys():
+                maxInFlight = modelList[key]['maxInFlight']
+
+            if not isinstance(maxInFlight, int) or maxInFlight < 1:
+                print("maxInFlight for model \"{}\" must be a positive integer, aborting...".format(key))
+                os._exit(1)
+
+            # Largest width or height the model works at, frames cropped to a region of interest are scaled down to it
+            inputSize = None
+            if 'inputSize' in modelList[key].keys():
+                inputSize = modelList[key]['inputSize']
+
+            # Results come back as JSON unless the binary format is asked for and the model server supports it
+            resultFormat = FORMAT_JSON
+            if 'format' in modelList[key].keys():
+                resultFormat = modelList[key]['format']
+
+            if not resultFormat in [FORMAT_JSON, FORMAT_BINARY]:
+                print("format for model \"{}\" must be \"{}\" or \"{}\", aborting...".format(key, FORMAT_JSON, FORMAT_BINARY))
+                os._exit(1)
+
+            # Seconds to wait for a reply to a frame before the replica is taken as failed
+            replyTimeout = DEFAULT_REPLY_TIMEOUT
+            if 'replyTimeout' in modelList[key].keys():
+                replyTimeout = modelList[key]['replyTimeout']
+
+            if not isinstance(replyTimeout, (int, float)) or replyTimeout <= 0:
+                print("replyTimeout for model \"{}\" must be a positive number of seconds, aborting...".format(key))
+                os._exit(1)
+
+            # A model can be served by several replicas, requests go to the least busy one
+            urls = modelList[key]['url']
+            if not isinstance(urls, list):
+                urls = [urls]
+
+            if len(urls) == 0:
+                print("url for model \"{}\" must not be an empty list, aborting...".format(key))
+                os._exit(1)
+
+            modelsMap[key] = {"url":urls[0], "urls":urls, "maxInFlight":maxInFlight, "inputSize":inputSize,
+                              "format":resultFormat, "replyTimeout":replyTimeout}
 
         return cls(modelsMap = modelsMap)
 
@@ -27,8 +89,21 @@ class ModelMap():
     def getModelUrl(self, name):
         return self.modelsMap[name]["url"]
 
+    def getModelUrls(self, name):
+        return self.modelsMap[name]["urls"]
+
+    def getMaxInFlight(self, name):
+        return self.modelsMap[name]["maxInFlight"]
+
+    def getInputSize(self, name):
+        return self.modelsMap[name]["inputSize"]
+
+    def getFormat(self, name):
+        return self.modelsMap[name]["format"]
+
 class Notify():
-    def __init__(self, name, zoneList:list, url, username, password, method, params, negate, enabled):
+    def __init__(self, name, zoneList:list, url, username, password, method, params, negate, enabled,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, cooldown=0.0, onChange=False):
         self.lock = threading.Lock()
         self.name = name
         self.zoneList = zoneList
@@ -39,6 +114,18 @@ class Notify():
         self.params = params
         self.negate = negate
         self.enabled = enabled
+        self.timeout = timeout
+        self.retries = retries
+        self.cooldown = cooldown
+        self.onChange = onChange
+
+        # Firing state, armed means the next frame that matches may fire when only changes are wanted
+        self.armed = True
+        self.lastFiredTime = None
+        self.lastFiredWallTime = None
+        self.firedCount = 0
+        self.suppressedCount = 0
+        self.unavailableCount = 0
 
     @classmethod
     def from_json(cls, polygonDict, notifyJson) -> 'Notify':
@@ -64,6 +151,29 @@ class Notify():
         else:
             negate = False
 
+        # Seconds allowed for the endpoint to answer and how many more times to try if it doesn't
+        if 'timeout' in notifyJson.keys():
+            timeout = notifyJson['timeout']
+        else:
+            timeout = DEFAULT_TIMEOUT
+
+        if 'retries' in notifyJson.keys():
+            retries = notifyJson['retries']
+        else:
+            retries = DEFAULT_RETRIES
+
+        # Minimum seconds between two notifications, matches in between are counted but not sent
+        if 'cooldown' in notifyJson.keys():
+            cooldown = notifyJson['cooldown']
+        else:
+            cooldown = 0.0
+
+        # True means only notify when the notification starts matching, not for every frame that matches
+        if 'onChange' in notifyJson.keys():
+            onChange = notifyJson['onChange']
+        else:
+            onChange = False
+
         return cls(name=notifyJson['name'],
                    zoneList=zoneList,
                    url=notifyJson['url'],
@@ -72,7 +182,11 @@ class Notify():
                    method=notifyJson['method'],
                    params=params,
                    negate=negate,
-                   enabled=enabled)
+                   enabled=enabled,
+                   timeout=timeout,
+                   retries=retries,
+                   cooldown=cooldown,
+                   onChange=onChange)
 
     @classmethod
     def notifyListBuilder(cls, notificationListJson):
@@ -87,6 +201,12 @@ class Notify():
     def getZoneList(self) -> 'list:Zone':
         return self.zoneList
 
+    def getModelNames(self) -> 'set':
+        modelNames = set()
+        for zone in self.zoneList:
+            modelNames |= zone.getModelNames()
+        return modelNames
+
     def getUrl(self):
         return self.url
 
@@ -102,6 +222,12 @@ class Notify():
     def getParams(self):
         return self.params
 
+    def getTimeout(self):
+        return self.timeout
+
+    def getRetries(self):
+        return self.retries
+
     def enable(self):
         self.lock.acquire()
         try:
@@ -129,8 +255,61 @@ class Notify():
 
         return enabled
 
+    def getCooldown(self):
+        return self.cooldown
+
+    def isOnChange(self):
+        return self.onChange
+
+    def shouldFire(self, matched, now=None) -> 'bool':
+        # Decides whether a frame where the notification matched, or negated didn't match, is sent
+        if now is None:
+            now = time.monotonic()
+
+        self.lock.acquire()
+        try:
+            if not matched:
+                self.armed = True
+                return False
+
+            if self.onChange and not self.armed:
+                self.suppressedCount += 1
+                return False
+
+            if self.lastFiredTime is not None and now - self.lastFiredTime < self.cooldown:
+                # Coalesced, when only changes are wanted the change is still sent once the cooldown is over
+                self.suppressedCount += 1
+                return False
+
+            self.armed = False
+            self.lastFiredTime = now
+            self.lastFiredWallTime = time.time()
+            self.firedCount += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def markUnavailable(self):
+        # A frame this notification couldn't be evaluated for because one of its models was unavailable
+        self.lock.acquire()
+        try:
+            self.unavailableCount += 1
+        finally:
+            self.lock.release()
+
+    def getCounters(self) -> 'dict':
+        self.lock.acquire()
+        try:
+            return {"fired": self.firedCount,
+                    "suppressed": self.suppressedCount,
+                    "unavailable": self.unavailableCount,
+                    "lastFired": self.lastFiredWallTime}
+        finally:
+            self.lock.release()
+
 class CameraReader(Thread):
-    def __init__(self, name, url, username, password, polygonDict, notifyList, enabled):
+    def __init__(self, name, url, username, password, polygonDict, notifyList, enabled, chunkSize=DEFAULT_CHUNK_SIZE,
+                 roiCrop=False, roiMargin=0, motionGate=None):
         Thread.__init__(self)
         self.lock = threading.Lock()
         self.enabled = True
@@ -142,7 +321,20 @@ class CameraReader(Thread):
         self.lastImage = None
         self.image = None
         self.notifyList = notifyList
+        self.rulePlan = RulePlan.compile(notifyList)
         self.enabled = enabled
+        self.chunkSize = chunkSize
+        self.roiCrop = roiCrop
+        self.roiMargin = roiMargin
+        self.motionGate = motionGate
+        self.receivedCount = 0
+        self.droppedCount = 0
+        self.replayFiles = None
+        self.replayFinished = False
+        self.consumedEvent = None
+        self.loop = None
+        self.loopThread = None
+        self.frameEvent = None
 
     @classmethod
     def from_json(cls, cameraJson) -> 'CameraReader':
@@ -163,13 +355,39 @@ class CameraReader(Thread):
         for notify in cameraJson['notifyList']:
             notifyList.append(Notify.from_json(polygonDict, notify))
 
-        return cls(name=cameraJson['name'],
-                   url=cameraJson['url'],
-                   username=cameraJson['username'],
-                   password=cameraJson['password'],
-                   polygonDict=polygonDict,
-                   notifyList=notifyList,
-                   enabled=enabled)
+        if 'chunkSize' in cameraJson.keys():
+            chunkSize = cameraJson['chunkSize']
+        else:
+            chunkSize = DEFAULT_CHUNK_SIZE
+
+        # True means only the part of the frame the enabled notifications look at is sent to the models
+        if 'roiCrop' in cameraJson.keys():
+            roiCrop = cameraJson['roiCrop']
+        else:
+            roiCrop = False
+
+        # Pixels kept around the polygons so objects standing on a polygon edge aren't cut in half
+        if 'roiMargin' in cameraJson.keys():
+            roiMargin = cameraJson['roiMargin']
+        else:
+            roiMargin = 0
+
+        camera = cls(name=cameraJson['name'],
+                      url=cameraJson['url'],
+                      username=cameraJson['username'],
+                      password=cameraJson['password'],
+                      polygonDict=polygonDict,
+                      notifyList=notifyList,
+                      enabled=enabled,
+                      chunkSize=chunkSize,
+                      roiCrop=roiCrop,
+                      roiMargin=roiMargin)
+
+        # Optionally only frames with motion inside the polygons the rules test are sent to the models
+        if 'motionGate' in cameraJson.keys():
+            camera.motionGate = MotionGate.from_json(camera.getRulePlan().getPolygons(), cameraJson['motionGate'])
+
+        return camera
 
     def isEnabled(self):
         self.lock.acquire()
@@ -208,12 +426,38 @@ class CameraReader(Thread):
     def getPassword(self):
         return self.password
 
+    def getChunkSize(self):
+        return self.chunkSize
+
+    def isRoiCrop(self):
+        return self.roiCrop
+
+    def getRoiMargin(self):
+        return self.roiMargin
+
+    def getMotionGate(self) -> 'MotionGate':
+        return self.motionGate
+
+    def getFrameCounts(self):
+        # Frames received from the camera and frames replaced before they could be processed
+        self.lock.acquire()
+        try:
+            return self.receivedCount, self.droppedCount
+        finally:
+            self.lock.release()
+
     def getImage(self):
         return self.image
 
     def getNotifyList(self) -> 'list:Notify':
         return self.notifyList
 
+    def getRulePlan(self) -> 'RulePlan':
+        return self.rulePlan
+
+    def getModelNames(self) -> 'set':
+        return self.rulePlan.getModelNames()
+
     def getLastImage(self):
         self.lock.acquire()
         try:
@@ -225,8 +469,19 @@ class CameraReader(Thread):
         finally:
             self.lock.release()
 
+        # A replay waiting to hand over its next frame
+        if returnImage is not None and self.consumedEvent is not None:
+            self.consumedEvent.set()
+
         return returnImage
 
+    def hasPendingImage(self):
+        self.lock.acquire()
+        try:
+            return self.image is not None and self.image != self.lastImage
+        finally:
+            self.lock.release()
+
     def connect(self):
         while True:
             if self.isEnabled():
@@ -239,31 +494,21 @@ class CameraReader(Thread):
 
                     print("Connected to \"{}\"".format(self.getName()))
 
-                    stream_bytes = bytes()
+                    # Uses the multipart boundary and part lengths when the camera sends them
+                    parser = MjpegParser.from_content_type(response.headers.get('Content-Type'))
 
                     count = 0
                     oldTotalTime = time.time()
                     t1 = time.time()
 
-                    for chunk in response.iter_content(chunk_size=1024):
+                    for chunk in response.iter_content(chunk_size=self.getChunkSize()):
                         if not self.isEnabled():
                             response.close()
                             print("Disconnect from \"{}\"".format(self.getName()))
                             break
 
-                        stream_bytes += chunk
-                        a = stream_bytes.find(b'\xff\xd8')
-                        b = stream_bytes.find(b'\xff\xd9')
-                        if a != -1 and b != -1:
-                            jpg = stream_bytes[a:b + 2]
-                            stream_bytes = stream_bytes[b + 2:]
-
-                            self.lock.acquire()
-                            try:
-                                self.image = MyImage(jpg, count)
-                            finally:
-                                self.lock.release()
-
+                        for jpg in parser.feed(chunk):
+                            self.setImage(MyImage(jpg, count))
                             count += 1
                 except Exception as e:
                     print("Caught exception reading video from {}, {}: {}, err: {}".format(self.getName(), self.getUrl(), type(e).__name__, str(e)))
@@ -273,6 +518,112 @@ class CameraReader(Thread):
     def run(self):
         self.connect()
 
+    def attachLoop(self, loop):
+        # New frames are signalled to the runner in this loop through frameEvent so it doesn't need to poll
+        self.loop = loop
+        self.loopThread = threading.current_thread()
+        self.frameEvent = asyncio.Event()
+
+    def startAsync(self, session:aiohttp.ClientSession):
+        # Read the stream inside the event loop instead of in a thread
+        return asyncio.ensure_future(self.connectAsync(session))
+
+    def startReplay(self, files, fps=None):
+        return asyncio.ensure_future(self.replayAsync(files, fps))
+
+    async def replayAsync(self, files, fps=None):
+        # Frames from recorded jpegs instead of the camera. At a given rate they arrive like they would from
+        # the camera and can be dropped, as fast as possible each frame waits for the one before it to be taken
+        self.replayFiles = files
+        self.consumedEvent = asyncio.Event()
+        start = time.monotonic()
+        for count, filename in enumerate(files):
+            with open(filename, "rb") as infile:
+                jpg = infile.read()
+
+            if fps:
+                delay = start + count / fps - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                while self.hasPendingImage():
+                    self.consumedEvent.clear()
+                    await self.consumedEvent.wait()
+
+            self.setImage(MyImage(jpg, count))
+
+        self.replayFinished = True
+        self.frameEvent.set()
+
+    def getReplayFrameName(self):
+        # File name of the recorded frame being processed
+        self.lock.acquire()
+        try:
+            lastImage = self.lastImage
+        finally:
+            self.lock.release()
+
+        if self.replayFiles is None or lastImage is None:
+            return None
+        return os.path.basename(self.replayFiles[lastImage.getCount()])
+
+    def setImage(self, image):
+        self.lock.acquire()
+        try:
+            # A frame that is replaced before it was picked up is never processed
+            if self.image is not None and self.image != self.lastImage:
+                self.droppedCount += 1
+            self.receivedCount += 1
+            self.image = image
+        finally:
+            self.lock.release()
+
+        if self.frameEvent is not None:
+            if threading.current_thread() is self.loopThread:
+                self.frameEvent.set()
+            else:
+                # From the reader thread, asyncio objects may only be touched from inside the loop
+                self.loop.call_soon_threadsafe(self.frameEvent.set)
+
+    async def waitForImage(self):
+        while True:
+            lastImage = self.getLastImage()
+            if lastImage is not None:
+                return lastImage
+
+            # None once a replay has handed over all of its frames
+            if self.replayFinished:
+                return None
+
+            self.frameEvent.clear()
+            await self.frameEvent.wait()
+
+    async def connectAsync(self, session:aiohttp.ClientSession):
+        while True:
+            if self.isEnabled():
+                try:
+                    async with session.get(self.getUrl(), auth=aiohttp.BasicAuth(self.getUsername(), self.getPassword())) as response:
+                        if response.status != 200:
+                            break
+
+                        print("Connected to \"{}\"".format(self.getName()))
+
+                        parser = MjpegParser.from_content_type(response.headers.get('Content-Type'))
+
+                        count = 0
+                        async for chunk in response.content.iter_any():
+                            if not self.isEnabled():
+                                print("Disconnect from \"{}\"".format(self.getName()))
+                                break
+
+                            for jpg in parser.feed(chunk):
+                                self.setImage(MyImage(jpg, count))
+                                count += 1
+                except Exception as e:
+                    print("Caught exception reading video from {}, {}: {}, err: {}".format(self.getName(), self.getUrl(), type(e).__name__, str(e)))
+
+            await asyncio.sleep(30)
+
 class Zone():
     def __init__(self, name:str, includeList:list, excludeList:list):
         self.name = name
@@ -301,6 +652,12 @@ class Zone():
     def getExcludeList(self):
         return self.excludeList
 
+    def getModelNames(self) -> 'set':
+        modelNames = set()
+        for include in self.includeList + self.excludeList:
+            modelNames |= include.getModelNames()
+        return modelNames
+
     def getMinHeight(self):
         return self.minHeight
 
@@ -346,6 +703,13 @@ class Include():
     def getModels(self) -> 'list:Model':
         return self.models
 
+    def getModelNames(self) -> 'set':
+        modelNames = set()
+        for modelList in self.models:
+            for model in modelList:
+                modelNames.add(model.getName())
+        return modelNames
+
 class Model():
     def __init__(self, name:str, category:str, minHeight:float, maxHeight:float,
                  minWidth:float, maxWidth:float,
@@ -452,10 +816,37 @@ class Model():
 
         return False
 
+    def containedMask(self, detections:'Detections'):
+        # Same test as isContained for all of the detections at once
+        if len(detections) == 0:
+            return np.zeros(0, dtype=bool)
+
+        w = detections.getWidths()
+        h = detections.getHeights()
+        mask = (detections.getProbs() >= self.getConfidence())\
+            & (w >= self.getMinWidth())\
+            & (w < self.getMaxWidth())\
+            & (h >= self.getMinHeight())\
+            & (h < self.getMaxHeight())
+
+        # Only the detections that pass the thresholds need the point in polygon test
+        candidates = np.flatnonzero(mask)
+        if len(candidates) > 0:
+            x = detections.getXs()[candidates]
+            y = detections.getYs()[candidates] + h[candidates] / 2
+            mask[candidates] = self.getPolygon().containsPoints(x, y)
+
+        return mask
+
+    def countContained(self, detections:'Detections') -> 'int':
+        return int(np.count_nonzero(self.containedMask(detections)))
+
 class SbtsPolygon():
     def __init__(self, pointList):
         self.pointList = pointList
         self.poly = Polygon(pointList)
+        if prepare is not None:
+            prepare(self.poly)
 
     @classmethod
     def from_json(cls, polygonJson) -> 'SbtsPolygon':
@@ -468,23 +859,88 @@ class SbtsPolygon():
     def contains(self, p):
         return self.poly.contains(p)
 
+    def containsPoints(self, x, y):
+        return contains_xy(self.poly, x, y)
+
     def getPointList(self):
         return self.pointList
 
     def getPoly(self):
         return self.poly
 
+class Detections():
+    # The detections of one category from one model held as arrays so they can be tested together
+    def __init__(self, category, probs, boxes, items=None):
+        self.category = category
+        self.probs = np.asarray(probs, dtype=np.float64)
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.items = items
+
+        # Boxes have always been truncated to whole pixels before being tested
+        truncated = np.trunc(self.boxes)
+        self.xs = truncated[:, 0]
+        self.ys = truncated[:, 1]
+        self.widths = truncated[:, 2]
+        self.heights = truncated[:, 3]
+
+    @classmethod
+    def from_items(cls, category, items) -> 'Detections':
+        return cls(category, [item[1] for item in items], [item[2][:4] for item in items], items)
+
+    def getCategory(self):
+        return self.category
+
+    def getItems(self):
+        # Results that arrived in the binary format only get turned into items when they are printed
+        if self.items is None:
+            self.items = [[self.category, prob, box] for prob, box in zip(self.probs.tolist(), self.boxes.tolist())]
+        return self.items
+
+    def getProbs(self):
+        return self.probs
+
+    def getBoxes(self):
+        return self.boxes
+
+    def getXs(self):
+        return self.xs
+
+    def getYs(self):
+        return self.ys
+
+    def getWidths(self):
+        return self.widths
+
+    def getHeights(self):
+        return self.heights
+
+    def __len__(self):
+        return len(self.probs)
+
 class MyImage():
-    def __init__(self, image, count):
+    def __init__(self, image, count, arrivalTime=None):
         self.image = image
         self.count = count
 
+        # When the last byte of the frame was read, on the time.monotonic() clock
+        if arrivalTime is None:
+            arrivalTime = time.monotonic()
+        self.arrivalTime = arrivalTime
+
     def getImage(self):
         return self.image
 
     def getCount(self):
         return self.count
 
+    def getArrivalTime(self):
+        return self.arrivalTime
+
+    def getAge(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return now - self.arrivalTime
+
 class SecureConfig():
     def __init__(self, modelsMap, cameras):
         self.modelsMap = modelsMap
@@ -496,3 +952,11 @@ class SecureConfig():
     def getCameras(self):
         return self.cameras
 
+    def getCategoryMap(self) -> 'dict':
+        # Every category each model is asked about by any camera, model servers only need to return those
+        categoryMap = {}
+        for camera in self.cameras:
+            for modelName, categories in camera.getRulePlan().getCategoryMap().items():
+                categoryMap.setdefault(modelName, set()).update(categories)
+        return categoryMap
+
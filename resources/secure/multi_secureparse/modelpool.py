@@ -0,0 +1,262 @@
+# Copyright, 2026, Kim Hendrikse
+
+import asyncio
+import time
+
+import websockets
+
+from multi_secureparse.metrics import Histogram
+from multi_secureparse.protocol import FORMAT_JSON, FORMAT_BINARY, helloMessage, parseHelloReply
+
+# Seconds before the first attempt to reconnect a replica that failed, doubled after every failed
+# attempt up to the maximum
+RECONNECT_INITIAL = 1.0
+RECONNECT_MAX = 30.0
+
+# Seconds to wait for a model server to reply to a frame before giving up on the replica
+DEFAULT_REPLY_TIMEOUT = 10.0
+
+MODEL_WAIT = Histogram("sbts_model_wait_seconds", "Time a request waited for an idle connection to a model server", ("model",))
+MODEL_ROUND_TRIP = Histogram("sbts_model_round_trip_seconds", "Time from sending a frame to a model server to its reply",
+                             ("model", "url"))
+
+class ModelUnavailable(Exception):
+    pass
+
+# One model server of a model name, with a connection per request that may be in flight
+class ModelReplica():
+    def __init__(self, modelName, url, maxInFlight, resultFormat=FORMAT_JSON, classes=None):
+        self.modelName = modelName
+        self.url = url
+        self.maxInFlight = maxInFlight
+        self.wantedFormat = resultFormat
+        self.classes = classes
+        self.resultFormat = FORMAT_JSON
+        self.names = None
+        self.connections = []
+        self.idle = []
+        self.healthy = False
+        self.reconnecting = False
+        self.requests = 0
+        self.failures = 0
+        self.reconnects = 0
+
+    async def connect(self):
+        # Opens every connection and agrees on the format and categories, raises when the server can't be reached
+        connections = []
+        resultFormat = self.wantedFormat
+        names = None
+        try:
+            for i in range(self.maxInFlight):
+                ws = await websockets.connect(self.url)
+                connections.append(ws)
+
+                # A server that doesn't know the hello keeps to JSON and returns every category
+                await ws.send(helloMessage(self.wantedFormat, self.classes))
+                reply = parseHelloReply(await ws.recv())
+                if reply is None or reply[0] != FORMAT_BINARY:
+                    resultFormat = FORMAT_JSON
+                else:
+                    names = reply[1]
+        except Exception:
+            for ws in connections:
+                await ws.close()
+            raise
+
+        if resultFormat != self.wantedFormat:
+            print("Model server {} for \"{}\" doesn't support binary results, using JSON".format(self.url, self.modelName))
+
+        # Connections that are still open from before are replaced, not left behind
+        for ws in self.connections:
+            asyncio.ensure_future(ws.close())
+
+        self.resultFormat = resultFormat
+        self.names = names
+        self.connections = connections
+        self.idle = list(connections)
+        self.healthy = True
+
+    def owns(self, ws):
+        return ws in self.connections
+
+    def markUnhealthy(self):
+        self.healthy = False
+        self.failures += 1
+        for ws in self.connections:
+            asyncio.ensure_future(ws.close())
+        self.connections = []
+        self.idle = []
+
+    def take(self):
+        self.requests += 1
+        return self.idle.pop()
+
+    def give(self, ws):
+        # Connections from before the replica was reconnected are dropped
+        if ws in self.connections:
+            self.idle.append(ws)
+
+    def isHealthy(self):
+        return self.healthy
+
+    def hasIdle(self):
+        return len(self.idle) > 0
+
+    def getInFlight(self):
+        return len(self.connections) - len(self.idle)
+
+    def getUrl(self):
+        return self.url
+
+    def getResultFormat(self):
+        return self.resultFormat
+
+    def getNames(self):
+        # Class names binary results index into, sent by the model server in reply to the hello
+        return self.names
+
+    def toJson(self):
+        return {"healthy": self.healthy, "inFlight": self.getInFlight(), "requests": self.requests,
+                "failures": self.failures, "reconnects": self.reconnects}
+
+# The replicas of one model name, requests go to the healthy one with the fewest in flight
+class ModelConnectionPool():
+    def __init__(self, modelName, replicas:list, inputSize=None, replyTimeout=DEFAULT_REPLY_TIMEOUT):
+        self.modelName = modelName
+        self.replicas = replicas
+        self.inputSize = inputSize
+        self.replyTimeout = replyTimeout
+        self.released = asyncio.Event()
+        self.available = False
+
+    async def connect(self):
+        # Replicas that can't be reached yet are left to connect in the background
+        for replica in self.replicas:
+            try:
+                await replica.connect()
+            except Exception as e:
+                print("Can't connect to model server {} for \"{}\": {}".format(replica.getUrl(), self.modelName, str(e)))
+                self.fail(replica, None)
+
+        self.checkAvailable()
+
+    def pickReplica(self) -> 'ModelReplica':
+        best = None
+        for replica in self.replicas:
+            if replica.isHealthy() and replica.hasIdle():
+                if best is None or replica.getInFlight() < best.getInFlight():
+                    best = replica
+        return best
+
+    async def acquire(self):
+        # Waits when all of the connections to the healthy replicas already have a request in flight
+        while True:
+            if not self.isAvailable():
+                raise ModelUnavailable("No model server for \"{}\" is available".format(self.modelName))
+
+            replica = self.pickReplica()
+            if replica is not None:
+                return replica, replica.take()
+
+            self.released.clear()
+            await self.released.wait()
+
+    def release(self, replica, ws):
+        replica.give(ws)
+        self.released.set()
+
+    def fail(self, replica, ws):
+        # A connection from before the replica was reconnected that fails late neither fails it again
+        # nor reconnects it, ws is None when the replica couldn't be connected at all
+        if ws is not None and not replica.owns(ws):
+            return
+
+        if replica.isHealthy():
+            replica.markUnhealthy()
+        if not replica.reconnecting:
+            replica.reconnecting = True
+            asyncio.ensure_future(self.reconnect(replica))
+
+        # Wake the waiting requests so they can pick another replica
+        self.checkAvailable()
+        self.released.set()
+
+    async def reconnect(self, replica):
+        delay = RECONNECT_INITIAL
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await replica.connect()
+            except Exception:
+                delay = min(delay * 2, RECONNECT_MAX)
+                continue
+
+            print("Reconnected to model server {} for \"{}\"".format(replica.getUrl(), self.modelName))
+            replica.reconnecting = False
+            replica.reconnects += 1
+            self.checkAvailable()
+            self.released.set()
+            return
+
+    def checkAvailable(self):
+        available = self.isAvailable()
+        if available != self.available:
+            if available:
+                print("Model \"{}\" is available".format(self.modelName))
+            else:
+                print("Model \"{}\" is unavailable, notifications using it are skipped".format(self.modelName))
+            self.available = available
+
+    async def request(self, message, trace=None):
+        # Sends a frame and returns the replica that answered with its reply, a request on a replica
+        # that fails is sent again to another one. A FrameTrace gets a span for the wait and each attempt
+        while True:
+            waitStart = time.monotonic()
+            replica, ws = await self.acquire()
+            sendTime = time.monotonic()
+            MODEL_WAIT.observe(sendTime - waitStart, (self.modelName,))
+            if trace is not None:
+                trace.span("wait", waitStart, sendTime, lane=self.modelName)
+            try:
+                await ws.send(message)
+                reply = await asyncio.wait_for(ws.recv(), self.replyTimeout)
+            except asyncio.TimeoutError:
+                # The connection can't be used again, a late reply would be taken as the answer to the next frame
+                print("Model server {} for \"{}\" didn't reply within {} seconds".format(replica.getUrl(), self.modelName,
+                                                                                      self.replyTimeout))
+                self.fail(replica, ws)
+                if trace is not None:
+                    trace.span("timed out " + replica.getUrl(), sendTime, time.monotonic(), lane=self.modelName)
+                continue
+            except (websockets.ConnectionClosed, OSError) as e:
+                print("Model server {} for \"{}\" closed the connection: {}".format(replica.getUrl(), self.modelName, str(e)))
+                self.fail(replica, ws)
+                if trace is not None:
+                    trace.span("failed " + replica.getUrl(), sendTime, time.monotonic(), lane=self.modelName)
+                continue
+
+            self.release(replica, ws)
+            replyTime = time.monotonic()
+            MODEL_ROUND_TRIP.observe(replyTime - sendTime, (self.modelName, replica.getUrl()))
+            if trace is not None:
+                trace.span(replica.getUrl(), sendTime, replyTime, lane=self.modelName,
+                           args={"sentBytes": len(message), "replyBytes": len(reply)})
+            return replica, reply
+
+    def isAvailable(self):
+        return any(replica.isHealthy() for replica in self.replicas)
+
+    def getModelName(self):
+        return self.modelName
+
+    def getReplicas(self) -> 'list:ModelReplica':
+        return self.replicas
+
+    def getInputSize(self):
+        return self.inputSize
+
+    def getReplyTimeout(self):
+        return self.replyTimeout
+
+    def toJson(self):
+        return {replica.getUrl(): replica.toJson() for replica in self.replicas}
@@ -0,0 +1,118 @@
+# Copyright, 2026, Kim Hendrikse
+
+import os
+import time
+
+import cv2
+import numpy as np
+
+# Decoding at 1/8 scale lets libjpeg skip most of the work, a 1920x1080 frame comes out at 240x135
+REDUCED_DECODES = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+DEFAULT_REDUCTION = 8
+DEFAULT_PIXEL_THRESHOLD = 25
+DEFAULT_CHANGED_FRACTION = 0.002
+DEFAULT_ALPHA = 0.05
+DEFAULT_REFRESH_INTERVAL = 10.0
+
+# Passes frames that changed enough inside the polygons against a running background, or after refreshInterval
+class MotionGate():
+    def __init__(self, polygons, reduction=DEFAULT_REDUCTION, pixelThreshold=DEFAULT_PIXEL_THRESHOLD,
+                 changedFraction=DEFAULT_CHANGED_FRACTION, alpha=DEFAULT_ALPHA, refreshInterval=DEFAULT_REFRESH_INTERVAL):
+        self.polygons = polygons
+        self.reduction = reduction
+        self.pixelThreshold = pixelThreshold
+        self.changedFraction = changedFraction
+        self.alpha = alpha
+        self.refreshInterval = refreshInterval
+        self.background = None
+        self.mask = None
+        self.maskCount = 0
+        self.lastPassedTime = None
+        self.passedCount = 0
+        self.skippedCount = 0
+
+    @classmethod
+    def from_json(cls, polygons, gateJson) -> 'MotionGate':
+        reduction = DEFAULT_REDUCTION
+        if 'reduction' in gateJson.keys():
+            reduction = gateJson['reduction']
+
+        if not reduction in REDUCED_DECODES.keys():
+            print("motionGate reduction must be one of {}, aborting...".format(sorted(REDUCED_DECODES.keys())))
+            os._exit(1)
+
+        pixelThreshold = DEFAULT_PIXEL_THRESHOLD
+        if 'pixelThreshold' in gateJson.keys():
+            pixelThreshold = gateJson['pixelThreshold']
+
+        # Part of the watched pixels that has to change for a frame to count as motion
+        changedFraction = DEFAULT_CHANGED_FRACTION
+        if 'changedFraction' in gateJson.keys():
+            changedFraction = gateJson['changedFraction']
+
+        # How quickly the background follows the scene, higher adapts faster to lighting changes
+        alpha = DEFAULT_ALPHA
+        if 'alpha' in gateJson.keys():
+            alpha = gateJson['alpha']
+
+        refreshInterval = DEFAULT_REFRESH_INTERVAL
+        if 'refreshInterval' in gateJson.keys():
+            refreshInterval = gateJson['refreshInterval']
+
+        return cls(polygons, reduction=reduction, pixelThreshold=pixelThreshold, changedFraction=changedFraction,
+                   alpha=alpha, refreshInterval=refreshInterval)
+
+    def makeMask(self, shape):
+        # Without any polygons the whole frame is watched
+        if len(self.polygons) == 0:
+            return np.ones(shape, dtype=bool)
+
+        # Polygons are in full frame pixels, the reduced decode is the frame divided by the reduction
+        mask = np.zeros(shape, dtype=np.uint8)
+        for polygon in self.polygons:
+            points = np.array(polygon.getPointList(), dtype=np.float64) / self.reduction
+            cv2.fillPoly(mask, [np.round(points).astype(np.int32)], 255)
+        return mask > 0
+
+    def check(self, jpg, now=None) -> 'bool':
+        if now is None:
+            now = time.monotonic()
+
+        gray = cv2.imdecode(np.frombuffer(jpg, np.uint8), REDUCED_DECODES[self.reduction])
+        if gray is None:
+            # Let the models deal with frames that can't be decoded like they always have
+            return self.passed(now)
+
+        gray = cv2.GaussianBlur(gray, (3, 3), 0).astype(np.float32)
+
+        if self.background is None or self.background.shape != gray.shape:
+            self.background = gray
+            self.mask = self.makeMask(gray.shape)
+            self.maskCount = max(1, int(np.count_nonzero(self.mask)))
+            return self.passed(now)
+
+        changed = np.count_nonzero((np.abs(gray - self.background) > self.pixelThreshold) & self.mask)
+        cv2.accumulateWeighted(gray, self.background, self.alpha)
+
+        if changed >= self.changedFraction * self.maskCount:
+            return self.passed(now)
+
+        if self.lastPassedTime is None or now - self.lastPassedTime >= self.refreshInterval:
+            return self.passed(now)
+
+        self.skippedCount += 1
+        return False
+
+    def passed(self, now) -> 'bool':
+        self.lastPassedTime = now
+        self.passedCount += 1
+        return True
+
+    def toJson(self):
+        return {"passed": self.passedCount, "skipped": self.skippedCount}
@@ -0,0 +1,121 @@
+# Copyright, 2026, Kim Hendrikse
+
+import asyncio
+import time
+
+import aiohttp
+
+from multi_secureparse.metrics import Histogram
+
+# Notifications waiting per endpoint before new ones are dropped
+DEFAULT_QUEUE_SIZE = 10
+
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.5
+
+NOTIFICATION_LATENCY = Histogram("sbts_notification_latency_seconds",
+                                 "Time from a notification firing to its endpoint answering or giving up", ("url",))
+
+class EndpointStats():
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retried = 0
+
+    def toJson(self):
+        return {"sent": self.sent, "failed": self.failed, "dropped": self.dropped, "retried": self.retried}
+
+# Delivers notifications in the background, with a bounded queue and delivery task per endpoint url
+class NotificationDispatcher():
+    def __init__(self, queueSize=DEFAULT_QUEUE_SIZE, backoff=DEFAULT_BACKOFF):
+        self.queueSize = queueSize
+        self.backoff = backoff
+        self.session = None
+        self.queues = {}
+        self.workers = {}
+        self.statsMap = {}
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=2))
+
+    async def close(self):
+        for worker in self.workers.values():
+            worker.cancel()
+        await self.session.close()
+
+    def submit(self, notify, trace=None) -> 'bool':
+        url = notify.getUrl()
+        if not url in self.queues.keys():
+            self.queues[url] = asyncio.Queue(maxsize=self.queueSize)
+            self.statsMap[url] = EndpointStats()
+            self.workers[url] = asyncio.ensure_future(self.deliverQueue(url, self.queues[url]))
+
+        try:
+            self.queues[url].put_nowait((notify, time.monotonic(), trace))
+        except asyncio.QueueFull:
+            self.statsMap[url].dropped += 1
+            print("Notification queue for {} is full, dropped: {}".format(url, notify.getName()))
+            return False
+
+        return True
+
+    async def deliverQueue(self, url, queue):
+        while True:
+            notify, submitted, trace = await queue.get()
+            deliverStart = time.monotonic()
+            try:
+                delivered = await self.deliver(notify)
+            except Exception as e:
+                # Whatever goes wrong with one notification, the endpoint's worker keeps going
+                print("Caught delivering notification {0}: {1}, err: {2}".format(notify.getName(), type(e).__name__, str(e)))
+                delivered = False
+            if delivered:
+                self.statsMap[url].sent += 1
+            else:
+                self.statsMap[url].failed += 1
+            deliverEnd = time.monotonic()
+            NOTIFICATION_LATENCY.observe(deliverEnd - submitted, (url,))
+
+            # Only the delivery is a span, notifications queued behind it would overlap it on the lane
+            if trace is not None:
+                trace.span(notify.getName(), deliverStart, deliverEnd, lane=url,
+                           args={"queuedMs": round((deliverStart - submitted) * 1000, 3), "delivered": delivered})
+
+    async def deliver(self, notify) -> 'bool':
+        # Credentials that can't be sent, like a username with a colon, won't work on a retry either
+        auth = None
+        try:
+            if notify.getUsername() is not None:
+                auth = aiohttp.BasicAuth(notify.getUsername(), notify.getPassword())
+        except ValueError as e:
+            print("Can't send notification {0} with its credentials: {1}".format(notify.getName(), str(e)))
+            return False
+
+        method = "GET"
+        if notify.getMethod() == "POST":
+            method = "POST"
+
+        retries = notify.getRetries()
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                self.statsMap[notify.getUrl()].retried += 1
+                await asyncio.sleep(self.backoff * (2 ** (attempt - 1)))
+
+            try:
+                async with self.session.request(method, notify.getUrl(), auth=auth, data=notify.getParams(),
+                                                timeout=aiohttp.ClientTimeout(total=notify.getTimeout())) as response:
+                    await response.read()
+
+                    # Only a server side error is worth trying again
+                    if response.status < 500:
+                        return True
+                    print("Notification {} got status {} from {}".format(notify.getName(), response.status, notify.getUrl()))
+            except Exception as e:
+                print("Caught firing notification: {0}, err: {1}".format(type(e).__name__, str(e)))
+
+        return False
+
+    def getStatsMap(self):
+        return self.statsMap
@@ -0,0 +1,181 @@
+# Copyright, 2026, Kim Hendrikse
+
+# One unique model, category, polygon and thresholds test, evaluated once per frame
+class Predicate():
+    def __init__(self, index, model):
+        self.index = index
+        self.model = model
+
+    @staticmethod
+    def keyOf(model) -> 'tuple':
+        return (model.getName(),
+                model.getCategory(),
+                tuple(model.getPolygon().getPointList()),
+                model.getMinHeight(),
+                model.getMaxHeight(),
+                model.getMinWidth(),
+                model.getMaxWidth(),
+                model.getConfidence())
+
+    def getIndex(self):
+        return self.index
+
+    def getModel(self):
+        return self.model
+
+    def getModelName(self):
+        return self.model.getName()
+
+    def getCategory(self):
+        return self.model.getCategory()
+
+class Term():
+    # A model entry from the notify tree, the shared predicate plus the settings that stay per entry
+    def __init__(self, predicate:Predicate, counter:int, advanceSkip:bool):
+        self.predicate = predicate
+        self.counter = counter
+        self.advanceSkip = advanceSkip
+
+    def getPredicate(self) -> 'Predicate':
+        return self.predicate
+
+    def getCounter(self):
+        return self.counter
+
+    def getAdvanceSkip(self):
+        return self.advanceSkip
+
+class IncludePlan():
+    # Each group is an inner model list, all of its terms have to hit for the group to trigger
+    def __init__(self, name, groups:list):
+        self.name = name
+        self.groups = groups
+
+    def getName(self):
+        return self.name
+
+    def getGroups(self) -> 'list:list:Term':
+        return self.groups
+
+class ZonePlan():
+    def __init__(self, name, excludeGroups:list, includes:list):
+        self.name = name
+        self.excludeGroups = excludeGroups
+        self.includes = includes
+
+    def getName(self):
+        return self.name
+
+    def getExcludeGroups(self) -> 'list:list:Term':
+        # The inner model lists of all of the exclude regions, any one of them hitting excludes the zone
+        return self.excludeGroups
+
+    def getIncludes(self) -> 'list:IncludePlan':
+        return self.includes
+
+def unionBounds(boundsList) -> 'tuple':
+    boundsList = [bounds for bounds in boundsList if bounds is not None]
+    if len(boundsList) == 0:
+        return None
+
+    return (min([bounds[0] for bounds in boundsList]),
+            min([bounds[1] for bounds in boundsList]),
+            max([bounds[2] for bounds in boundsList]),
+            max([bounds[3] for bounds in boundsList]))
+
+class NotifyPlan():
+    def __init__(self, notify, zones:list, modelNames:set, bounds:tuple):
+        self.notify = notify
+        self.zones = zones
+        self.modelNames = modelNames
+        self.bounds = bounds
+
+    def getNotify(self):
+        return self.notify
+
+    def getZones(self) -> 'list:ZonePlan':
+        return self.zones
+
+    def getModelNames(self) -> 'set':
+        return self.modelNames
+
+    def getBounds(self) -> 'tuple':
+        # minX, minY, maxX, maxY of all of the polygons the notification tests
+        return self.bounds
+
+# A camera's notify list compiled to deduplicated predicates, evaluated in the same order as the tree
+class RulePlan():
+    def __init__(self, predicates:list, notifications:list):
+        self.predicates = predicates
+        self.notifications = notifications
+
+    @classmethod
+    def compile(cls, notifyList) -> 'RulePlan':
+        predicateMap = {}
+        predicates = []
+        polygonBounds = []
+
+        def term(model):
+            key = Predicate.keyOf(model)
+            if not key in predicateMap.keys():
+                predicate = Predicate(len(predicates), model)
+                predicateMap[key] = predicate
+                predicates.append(predicate)
+            polygonBounds.append(model.getPolygon().getPoly().bounds)
+            return Term(predicateMap[key], model.getCounter(), model.getAdvanceSkip())
+
+        def groups(include):
+            return [[term(model) for model in modelList] for modelList in include.getModels()]
+
+        notifications = []
+        for notify in notifyList:
+            del polygonBounds[:]
+            zones = []
+            for zone in notify.getZoneList():
+                excludeGroups = []
+                for exclude in zone.getExcludeList():
+                    excludeGroups.extend(groups(exclude))
+
+                includes = []
+                for include in zone.getIncludeList():
+                    includes.append(IncludePlan(include.getName(), groups(include)))
+
+                zones.append(ZonePlan(zone.getName(), excludeGroups, includes))
+            notifications.append(NotifyPlan(notify, zones, notify.getModelNames(), unionBounds(polygonBounds)))
+
+        return cls(predicates, notifications)
+
+    def getPredicates(self) -> 'list:Predicate':
+        return self.predicates
+
+    def getNotifications(self) -> 'list:NotifyPlan':
+        return self.notifications
+
+    def getModelNames(self) -> 'set':
+        # Only the enabled notifications need their models run
+        modelNames = set()
+        for notifyPlan in self.notifications:
+            if notifyPlan.getNotify().isEnabled():
+                modelNames |= notifyPlan.getModelNames()
+        return modelNames
+
+    def getCategoryMap(self) -> 'dict':
+        # Categories per model of all of the notifications, disabled ones can be enabled at any time
+        categoryMap = {}
+        for predicate in self.predicates:
+            categoryMap.setdefault(predicate.getModelName(), set()).add(predicate.getCategory())
+        return categoryMap
+
+    def getPolygons(self) -> 'list:SbtsPolygon':
+        # Every polygon a predicate tests, named or given inline, each once
+        polygons = []
+        for predicate in self.predicates:
+            polygon = predicate.getModel().getPolygon()
+            if not any(polygon is other for other in polygons):
+                polygons.append(polygon)
+        return polygons
+
+    def getBounds(self) -> 'tuple':
+        # The area of the frame the enabled notifications look at, None when there isn't any
+        return unionBounds([notifyPlan.getBounds() for notifyPlan in self.notifications
+                            if notifyPlan.getNotify().isEnabled()])
@@ -0,0 +1,50 @@
+# Copyright, 2026, Kim Hendrikse
+
+import json
+import struct
+
+import numpy as np
+
+# A binary result is a header with the number of detections followed by one packed record per
+# detection. Class names are not repeated in every result, the server sends them once in its reply
+# to the hello that starts the connection.
+RESULT_MAGIC = b'SBD1'
+RESULT_HEADER = struct.Struct('<4sI')
+RESULT_RECORD = np.dtype([('cls', '<i4'), ('conf', '<f4'), ('box', '<f4', (4,))])
+
+FORMAT_JSON = "json"
+FORMAT_BINARY = "binary"
+
+def helloMessage(resultFormat=FORMAT_BINARY, classes=None) -> 'str':
+    # Servers leave out every category not in classes, None asks for all of them
+    hello = {"format": resultFormat}
+    if classes is not None:
+        hello['classes'] = list(classes)
+    return json.dumps({"hello": hello})
+
+def parseHelloReply(reply):
+    # The agreed format and class names, None from servers that predate the hello and reply with []
+    try:
+        replyJson = json.loads(reply)
+    except Exception:
+        return None
+
+    if not isinstance(replyJson, dict) or not 'format' in replyJson.keys():
+        return None
+
+    return replyJson['format'], replyJson.get('names', [])
+
+def decodeRecords(data):
+    magic, count = RESULT_HEADER.unpack_from(data)
+    if magic != RESULT_MAGIC:
+        raise Exception("Not a binary detection result")
+
+    if len(data) != RESULT_HEADER.size + count * RESULT_RECORD.itemsize:
+        raise Exception("Binary detection result has the wrong size for {} detections".format(count))
+
+    return np.frombuffer(data, dtype=RESULT_RECORD, count=count, offset=RESULT_HEADER.size)
+
+def recordsToList(records, names) -> 'list':
+    # The same [name, conf, [x, y, w, h]] items a JSON reply holds
+    return [[names[cls], conf, box] for cls, conf, box in
+            zip(records['cls'].tolist(), records['conf'].tolist(), records['box'].tolist())]
@@ -0,0 +1,50 @@
+# Copyright, 2026, Kim Hendrikse
+
+import json
+import sys
+import time
+from os import listdir
+from os.path import isdir, isfile, join
+
+def replayFileList(directory) -> 'list':
+    # The recorded frames in the order sbts-annotate reads them, skipping its annotated output
+    fileList = []
+    for filename in sorted(listdir(directory)):
+        fullPath = join(directory, filename)
+        if isfile(fullPath) and filename.endswith(".jpg") and not "_ano_" in filename:
+            fileList.append(fullPath)
+    return fileList
+
+def replayDirectory(directory, cameraName):
+    # A sub directory named after the camera is used when there is one, otherwise every camera replays the same frames
+    cameraDirectory = join(directory, cameraName)
+    if isdir(cameraDirectory):
+        return cameraDirectory
+    return directory
+
+# Notifications written as JSON lines instead of being sent, so two replays can be compared
+class NotificationLog():
+    def __init__(self, filename):
+        self.filename = filename
+        if filename == "-":
+            self.outfile = sys.stdout
+        else:
+            self.outfile = open(filename, "w")
+        self.count = 0
+
+    def record(self, notify, cameraName, frameName):
+        self.outfile.write(json.dumps({"time": round(time.time(), 6),
+                                       "camera": cameraName,
+                                       "frame": frameName,
+                                       "notification": notify.getName(),
+                                       "url": notify.getUrl()}) + "\n")
+        self.count += 1
+
+    def getCount(self):
+        return self.count
+
+    def close(self):
+        if self.outfile is not sys.stdout:
+            self.outfile.close()
+        else:
+            self.outfile.flush()
@@ -0,0 +1,102 @@
+# Copyright, 2026, Kim Hendrikse
+
+import math
+import threading
+
+import cv2
+import numpy as np
+
+JPEG_QUALITY = 90
+
+class RoiTransform():
+    # Maps detections from the cropped and scaled image sent to a model back to the original frame
+    def __init__(self, x0, y0, scaleX, scaleY):
+        self.x0 = x0
+        self.y0 = y0
+        self.scaleX = scaleX
+        self.scaleY = scaleY
+
+    def mapBack(self, boxes):
+        # Rows of x, y, w, h
+        scale = np.array([self.scaleX, self.scaleY, self.scaleX, self.scaleY])
+        return boxes / scale + np.array([self.x0, self.y0, 0, 0])
+
+    def getOffset(self):
+        return self.x0, self.y0
+
+    def getScale(self):
+        return self.scaleX, self.scaleY
+
+# A camera frame cropped to the area the enabled notifications look at, encoded once per model input size
+class RoiFrame():
+    def __init__(self, jpg, bounds, margin=0):
+        self.jpg = jpg
+        self.bounds = bounds
+        self.margin = margin
+        self.frame = None
+        self.crop = None
+        self.encodedMap = {}
+        self.lock = threading.Lock()
+
+    def getCrop(self):
+        if self.crop is None:
+            self.frame = cv2.imdecode(np.frombuffer(self.jpg, np.uint8), cv2.IMREAD_COLOR)
+            if self.frame is None:
+                # A broken frame can't be cropped, the models get it as it is
+                return None
+            height, width = self.frame.shape[:2]
+
+            minX, minY, maxX, maxY = self.bounds
+            x0 = max(0, int(math.floor(minX)) - self.margin)
+            y0 = max(0, int(math.floor(minY)) - self.margin)
+            x1 = min(width, int(math.ceil(maxX)) + self.margin + 1)
+            y1 = min(height, int(math.ceil(maxY)) + self.margin + 1)
+
+            if x1 <= x0 or y1 <= y0:
+                # Regions entirely off the frame, fall back to the whole frame
+                x0, y0, x1, y1 = 0, 0, width, height
+
+            self.crop = (x0, y0, x1, y1, x0 == 0 and y0 == 0 and x1 == width and y1 == height)
+
+        return self.crop
+
+    def forModel(self, inputSize=None):
+        if self.bounds is None:
+            return self.jpg, None
+
+        # Models asking at the same time from executor threads share the decode
+        with self.lock:
+            return self.encode(inputSize)
+
+    def encode(self, inputSize):
+        if not inputSize in self.encodedMap.keys():
+            crop = self.getCrop()
+            if crop is None:
+                return self.jpg, None
+            x0, y0, x1, y1, wholeFrame = crop
+
+            # Only ever scale down, there is nothing to gain sending a model more pixels than it uses
+            scale = 1.0
+            if inputSize is not None:
+                scale = min(1.0, inputSize / float(max(x1 - x0, y1 - y0)))
+
+            if wholeFrame and scale == 1.0:
+                self.encodedMap[inputSize] = (self.jpg, None)
+            else:
+                image = self.frame[y0:y1, x0:x1]
+                scaleX, scaleY = 1.0, 1.0
+                if scale < 1.0:
+                    newSize = (max(1, int(round((x1 - x0) * scale))), max(1, int(round((y1 - y0) * scale))))
+                    image = cv2.resize(image, newSize, interpolation=cv2.INTER_AREA)
+
+                    # Use the exact ratios of the resized image so the mapping back lines up
+                    scaleX = newSize[0] / float(x1 - x0)
+                    scaleY = newSize[1] / float(y1 - y0)
+
+                success, encoded = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
+                if not success:
+                    raise Exception("Could not encode the region of interest to a jpeg")
+
+                self.encodedMap[inputSize] = (encoded.tobytes(), RoiTransform(x0, y0, scaleX, scaleY))
+
+        return self.encodedMap[inputSize]
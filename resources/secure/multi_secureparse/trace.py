@@ -0,0 +1,111 @@
+# Copyright, 2026, Kim Hendrikse
+
+import json
+import os
+import random
+import time
+
+# The spans of one frame, kept until it is processed and written if the tracer keeps the frame
+class FrameTrace():
+    def __init__(self, tracer, cameraName, count, arrivalTime, sampled):
+        self.tracer = tracer
+        self.cameraName = cameraName
+        self.count = count
+        self.arrivalTime = arrivalTime
+        self.sampled = sampled
+        self.spans = []
+        self.fired = []
+        self.finished = False
+        self.kept = False
+
+    def span(self, name, start, end, lane=None, args=None):
+        # Spans on other lanes than the camera's own may overlap, like the models a frame is sent to at the same time
+        span = (name, start, end, self.laneName(lane), args)
+        if not self.finished:
+            self.spans.append(span)
+        elif self.kept:
+            self.tracer.write([span])
+
+    def laneName(self, lane):
+        if lane is None:
+            return self.cameraName
+        return "{} / {}".format(self.cameraName, lane)
+
+    def markFired(self, notifyName):
+        self.fired.append(notifyName)
+
+    def getCameraName(self):
+        return self.cameraName
+
+    def getArrivalTime(self):
+        return self.arrivalTime
+
+# Writes the spans of sampled frames as Chrome trace events, for chrome://tracing or Perfetto
+class Tracer():
+    def __init__(self, filename, sampleRate=1.0, keepFired=False, seed=None):
+        self.filename = filename
+        self.sampleRate = sampleRate
+        self.keepFired = keepFired
+        self.rng = random.Random(seed)
+        self.pid = os.getpid()
+        self.laneMap = {}
+        self.outfile = open(filename, "w")
+        self.outfile.write("[\n")
+        self.first = True
+        self.frameCount = 0
+
+    def startFrame(self, cameraName, image) -> 'FrameTrace':
+        # None for a frame that won't be written, so nothing is recorded for it
+        sampled = self.rng.random() < self.sampleRate
+        if not sampled and not self.keepFired:
+            return None
+        return FrameTrace(self, cameraName, image.getCount(), image.getArrivalTime(), sampled)
+
+    def finishFrame(self, frameTrace:FrameTrace, end=None):
+        if end is None:
+            end = time.monotonic()
+
+        frameTrace.finished = True
+        frameTrace.kept = frameTrace.sampled or (self.keepFired and len(frameTrace.fired) > 0)
+        if not frameTrace.kept:
+            return
+
+        self.frameCount += 1
+        frameSpan = ("frame {}".format(frameTrace.count), frameTrace.arrivalTime, end, frameTrace.laneName(None),
+                     {"totalMs": round((end - frameTrace.arrivalTime) * 1000, 3), "fired": frameTrace.fired})
+        self.write([frameSpan] + frameTrace.spans)
+
+    def laneId(self, lane):
+        # Lanes show up as threads in the viewers, named by a metadata event the first time they are used
+        if not lane in self.laneMap.keys():
+            laneId = len(self.laneMap) + 1
+            self.laneMap[lane] = laneId
+            self.writeEvents([{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": laneId, "args": {"name": lane}},
+                              {"name": "thread_sort_index", "ph": "M", "pid": self.pid, "tid": laneId,
+                               "args": {"sort_index": laneId}}])
+        return self.laneMap[lane]
+
+    def write(self, spans):
+        events = []
+        for name, start, end, lane, args in spans:
+            event = {"name": name, "ph": "X", "pid": self.pid, "tid": self.laneId(lane),
+                     "ts": round(start * 1e6, 1), "dur": round(max(0.0, end - start) * 1e6, 1)}
+            if args is not None:
+                event["args"] = args
+            events.append(event)
+        self.writeEvents(events)
+        self.outfile.flush()
+
+    def writeEvents(self, events):
+        for event in events:
+            if not self.first:
+                self.outfile.write(",\n")
+            self.outfile.write(json.dumps(event))
+            self.first = False
+
+    def getFrameCount(self):
+        return self.frameCount
+
+    def close(self):
+        self.outfile.write("\n]\n")
+        self.outfile.close()
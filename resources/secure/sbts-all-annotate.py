@@ -15,11 +15,15 @@ import cv2
 import numpy as np
 import websockets
 
+from multi_secureparse.protocol import FORMAT_BINARY, helloMessage, parseHelloReply, decodeRecords, recordsToList
 
-async def fetch(ws, image):
+
+async def fetch(ws, image, names=None):
     try:
         await ws.send(image)
         r = await ws.recv()
+        if isinstance(r, bytes):
+            return recordsToList(decodeRecords(r), names)
         return json.loads(r)
     except websockets.ConnectionClosed as e:
         print("Caught error: {0}".format(e))
@@ -80,8 +84,21 @@ def resize_image_if_needed(jpg, max_dimension):
         # Return the original image bytes if no resizing is needed
         return jpg
 
-async def annotator():
+async def connect():
     ws = await websockets.connect(args.url)
+    if not args.binary:
+        return ws, None
+
+    await ws.send(helloMessage(FORMAT_BINARY))
+    reply = parseHelloReply(await ws.recv())
+    if reply is None or reply[0] != FORMAT_BINARY:
+        print("Server doesn't support binary results, using JSON")
+        return ws, None
+
+    return ws, reply[1]
+
+async def annotator():
+    ws, names = await connect()
     for filename in getFileList():
         with open(filename, "rb") as infile:
             jpg = infile.read()
@@ -94,7 +111,7 @@ async def annotator():
             count_map = {}
 
             try:
-                result = await fetch(ws, jpg)
+                result = await fetch(ws, jpg, names)
                 for item in result:
                     category = item[0]
                     prob = item[1]
@@ -148,6 +165,7 @@ parser = argparse.ArgumentParser()
 parser.add_argument("-f", "--file-name-list", dest="file_name_list", help="List of files from the directory to annotate")
 parser.add_argument("-s", "--scale-to", dest="scale_to", help="Scale image size to this max for either width or height")
 parser.add_argument('-c', action='store_true', help='Count all of the occurances of each match and output for each file')
+parser.add_argument('-b', '--binary', action='store_true', help='Ask the server for results in the binary format')
 parser.add_argument("directory", help="Directory")
 parser.add_argument("url", help="Url of yolo server")
 args = parser.parse_args()
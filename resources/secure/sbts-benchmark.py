@@ -0,0 +1,363 @@
+#!/usr/bin/python3
+
+# Copyright, 2026, Kim Hendrikse
+
+# Microbenchmarks for the parts of sbts-secure that run for every frame: the polygon tests, the rule
+# evaluation, indexing a model's reply by category and parsing the camera stream. Results can be
+# written as JSON and compared against an earlier run to catch a change that made one of them slower.
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import math
+import platform
+import random
+import sys
+import time
+from os.path import abspath, dirname, join
+
+import cv2
+import numpy as np
+
+from multi_secureparse.model import Model, SbtsPolygon, Detections, CameraReader, DEFAULT_CHUNK_SIZE
+from multi_secureparse.mjpeg import MjpegParser
+from multi_secureparse.protocol import RESULT_HEADER, RESULT_MAGIC, RESULT_RECORD
+
+BENCHMARKS = ["isContained", "rules", "resultCache", "mjpeg"]
+MODEL_NAMES = ["yolov7", "yolov4"]
+CATEGORIES = ["person", "car", "dog"]
+FRAME_WIDTH = 640
+FRAME_HEIGHT = 480
+
+def loadSecure():
+    # sbts-secure.py only starts running when it is the main script, loaded here for its functions
+    spec = importlib.util.spec_from_file_location("sbts_secure", join(dirname(abspath(__file__)), "sbts-secure.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def makePolygon():
+    return SbtsPolygon([(2, 239), (316, 241), (318, 357), (180, 420), (3, 356)])
+
+def makeModel(polygon):
+    return Model(name="yolov7", category="person", minHeight=35, maxHeight=570, minWidth=10, maxWidth=200,
+                 confidence=0.5, advanceSkip=False, counter=1, polygon=polygon)
+
+def makeItems(count, rng, categories=("person",)):
+    items = []
+    for i in range(count):
+        items.append([rng.choice(categories), rng.random(), [rng.uniform(0, FRAME_WIDTH), rng.uniform(0, FRAME_HEIGHT),
+                                                             rng.uniform(5, 250), rng.uniform(10, 600)]])
+    return items
+
+def timeCall(function, iterations):
+    # Mean seconds per call of the fastest of --repeat runs, the least disturbed by anything else running
+    result = function()
+    best = None
+    for run in range(args.repeat):
+        start = time.perf_counter()
+        for i in range(iterations):
+            function()
+        elapsed = (time.perf_counter() - start) / iterations
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+def countIsContained(model, items):
+    # The per detection loop sbts-secure used before the detections were tested as arrays
+    count = 0
+    for item in items:
+        prob = item[1]
+        x, y, w, h = item[2][0], item[2][1], item[2][2], item[2][3]
+        if (model.isContained(prob, int(x), int(y), int(w), int(h))):
+            count += 1
+    return count
+
+def countContainedMask(model, items):
+    return model.countContained(Detections.from_items("person", items))
+
+def benchIsContained(sizes, rng):
+    model = makeModel(makePolygon())
+
+    results = []
+    print("{0:>10} {1:>14} {2:>14} {3:>9}".format("detections", "isContained us", "vectorized us", "speedup"))
+    for size in sizes:
+        items = makeItems(size, rng)
+        loopCount, loopTime = timeCall(lambda: countIsContained(model, items), args.iterations)
+        maskCount, maskTime = timeCall(lambda: countContainedMask(model, items), args.iterations)
+
+        if loopCount != maskCount:
+            print("Hit counts differ for {0} detections: {1} != {2}".format(size, loopCount, maskCount))
+            sys.exit(1)
+
+        print("{0:>10} {1:>14.1f} {2:>14.1f} {3:>8.1f}x".format(size, loopTime * 1e6, maskTime * 1e6, loopTime / maskTime))
+        results.append({"case": "isContained", "detections": size, "us": loopTime * 1e6})
+        results.append({"case": "containedMask", "detections": size, "us": maskTime * 1e6})
+    return results
+
+def makePolygonJson(rng):
+    # A star shaped polygon somewhere in the frame, between 4 and 10 points
+    cx = rng.uniform(50, FRAME_WIDTH - 50)
+    cy = rng.uniform(50, FRAME_HEIGHT - 50)
+    points = rng.randint(4, 10)
+    polygonJson = []
+    for i in range(points):
+        angle = 2 * math.pi * i / points
+        radius = rng.uniform(20, 200)
+        polygonJson.append({"x": int(cx + radius * math.cos(angle)), "y": int(cy + radius * math.sin(angle))})
+    return polygonJson
+
+def makeModelJson(rng, polygonNames):
+    return {"name": rng.choice(MODEL_NAMES), "category": rng.choice(CATEGORIES),
+            "minHeight": rng.choice([0, 20, 35]), "maxHeight": rng.choice([300, 600]),
+            "minWidth": rng.choice([0, 10]), "maxWidth": rng.choice([200, 400]),
+            "confidence": rng.choice([0.3, 0.5, 0.7]), "advanceSkip": rng.random() < 0.2,
+            "counter": rng.choice([1, 1, 2]), "namedPolygon": rng.choice(polygonNames)}
+
+def makeIncludeJson(rng, name, polygonNames):
+    return {"name": name, "models": [[makeModelJson(rng, polygonNames) for j in range(rng.randint(1, 2))]
+                                     for i in range(rng.randint(1, 2))]}
+
+def makeCameraJson(notifications, polygons, rng):
+    # A camera with many notifications over many polygons, mostly including with some excludes and negations
+    polygonDict = {"Polygon {}".format(i): makePolygonJson(rng) for i in range(polygons)}
+    polygonNames = list(polygonDict.keys())
+
+    notifyList = []
+    for i in range(notifications):
+        zoneList = []
+        for j in range(rng.randint(1, 2)):
+            zoneList.append({"name": "Zone {}.{}".format(i, j),
+                             "includeList": [makeIncludeJson(rng, "Include {}.{}.{}".format(i, j, k), polygonNames)
+                                             for k in range(rng.randint(1, 3))],
+                             "excludeList": [makeIncludeJson(rng, "Exclude {}.{}.{}".format(i, j, k), polygonNames)
+                                             for k in range(rng.randint(0, 1))]})
+        notifyList.append({"name": "Notify {}".format(i), "zoneList": zoneList, "url": "http://127.0.0.1/", "username": "",
+                           "password": "", "method": "POST", "params": {}, "negate": rng.random() < 0.1})
+
+    return {"name": "Benchmark", "url": "", "username": "", "password": "", "polygonDict": polygonDict,
+            "notifyList": notifyList}
+
+def makeCategoryMap(size, rng):
+    # What ResultCache holds once every model has answered, the detections split over the categories
+    categoryMap = {}
+    for modelName in MODEL_NAMES:
+        items = makeItems(size, rng, CATEGORIES)
+        categoryMap[modelName] = {category: Detections.from_items(category, [item for item in items if item[0] == category])
+                                  for category in CATEGORIES}
+    return categoryMap
+
+def benchRules(secure, sizes, rng):
+    camera = CameraReader.from_json(makeCameraJson(args.notifications, args.polygons, rng))
+    rulePlan = camera.getRulePlan()
+    loop = asyncio.get_event_loop()
+
+    fired = []
+    secure.fireNotification = lambda notify, camera, trace=None: fired.append(notify)
+
+    def processFrame(categoryMap):
+        # A new cache per frame like processCamera, already holding the replies so no model is asked
+        resultCache = secure.ResultCache({})
+        resultCache.categoryMap = {modelName: dict(categories) for modelName, categories in categoryMap.items()}
+        loop.run_until_complete(secure.processResult(resultCache, None, secure.ReturnResult(), camera))
+
+    results = []
+    print("{0} notifications, {1} polygons, {2} predicates".format(
+        args.notifications, args.polygons, len(rulePlan.getPredicates())))
+    print("{0:>10} {1:>14} {2:>10}".format("detections", "processResult us", "fired"))
+    for size in sizes:
+        categoryMap = makeCategoryMap(size, rng)
+        result, elapsed = timeCall(lambda: processFrame(categoryMap), max(1, args.iterations // 10))
+
+        # Notifications one frame fires, a check that the rules aren't all trivially false
+        del fired[:]
+        processFrame(categoryMap)
+
+        print("{0:>10} {1:>14.1f} {2:>10}".format(size, elapsed * 1e6, len(fired)))
+        results.append({"case": "processResult", "detections": size, "us": elapsed * 1e6,
+                        "notifications": args.notifications, "polygons": args.polygons,
+                        "predicates": len(rulePlan.getPredicates())})
+    return results
+
+class CannedReplica():
+    def __init__(self, names):
+        self.names = names
+
+    def getNames(self):
+        return self.names
+
+class CannedPool():
+    # Answers every request straight away with the same reply, so only the decoding is timed
+    def __init__(self, replica, reply):
+        self.replica = replica
+        self.reply = reply
+
+    def getInputSize(self):
+        return None
+
+    async def request(self, message, trace=None):
+        return self.replica, self.reply
+
+def makeBinaryReply(items, names):
+    records = np.empty(len(items), dtype=RESULT_RECORD)
+    for i, item in enumerate(items):
+        records[i] = (names.index(item[0]), item[1], item[2][:4])
+    return RESULT_HEADER.pack(RESULT_MAGIC, len(records)) + records.tobytes()
+
+def benchResultCache(secure, sizes, rng):
+    loop = asyncio.get_event_loop()
+
+    def fetch(pool):
+        resultCache = secure.ResultCache({})
+        return loop.run_until_complete(resultCache.fetch(pool, "yolov7", None))
+
+    results = []
+    print("{0:>10} {1:>10} {2:>10}".format("detections", "json us", "binary us"))
+    for size in sizes:
+        items = makeItems(size, rng, CATEGORIES)
+        jsonPool = CannedPool(CannedReplica(None), json.dumps(items))
+        binaryPool = CannedPool(CannedReplica(CATEGORIES), makeBinaryReply(items, CATEGORIES))
+
+        jsonMap, jsonTime = timeCall(lambda: fetch(jsonPool), args.iterations)
+        binaryMap, binaryTime = timeCall(lambda: fetch(binaryPool), args.iterations)
+
+        jsonCounts = {category: len(detections) for category, detections in jsonMap.items()}
+        binaryCounts = {category: len(detections) for category, detections in binaryMap.items()}
+        if jsonCounts != binaryCounts:
+            print("Categories differ for {0} detections: {1} != {2}".format(size, jsonCounts, binaryCounts))
+            sys.exit(1)
+
+        print("{0:>10} {1:>10.1f} {2:>10.1f}".format(size, jsonTime * 1e6, binaryTime * 1e6))
+        results.append({"case": "fetch json", "detections": size, "us": jsonTime * 1e6})
+        results.append({"case": "fetch binary", "detections": size, "us": binaryTime * 1e6})
+    return results
+
+def makeStream(jpgs, useLength):
+    parts = []
+    for jpg in jpgs:
+        headers = b"--sbtsframe\r\nContent-Type: image/jpeg\r\n"
+        if useLength:
+            headers += "Content-Length: {}\r\n".format(len(jpg)).encode("latin-1")
+        parts.append(headers + b"\r\n" + jpg + b"\r\n")
+    return b"".join(parts)
+
+def benchMjpeg(rng):
+    results = []
+    print("{0:>10} {1:>8} {2:>10} {3:>10} {4:>8}".format("resolution", "headers", "kb/frame", "us/frame", "MB/s"))
+    for width, height in [(640, 480), (1280, 720), (1920, 1080)]:
+        # Noise compresses badly, so the frames are about as large as a busy scene's
+        image = cv2.GaussianBlur(np.random.RandomState(rng.randint(0, 1000)).randint(0, 256, (height, width, 3), dtype=np.uint8), (5, 5), 0)
+        jpgs = [cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 80 - i])[1].tobytes() for i in range(10)]
+
+        for useLength in [True, False]:
+            stream = makeStream(jpgs, useLength)
+            chunks = [stream[i:i + DEFAULT_CHUNK_SIZE] for i in range(0, len(stream), DEFAULT_CHUNK_SIZE)]
+
+            def parse():
+                parser = MjpegParser.from_content_type("multipart/x-mixed-replace; boundary=sbtsframe")
+                frames = 0
+                for chunk in chunks:
+                    frames += len(parser.feed(chunk))
+                return frames
+
+            frames, elapsed = timeCall(parse, max(1, args.iterations // 10))
+            if frames != len(jpgs):
+                print("Parsed {0} frames out of {1}".format(frames, len(jpgs)))
+                sys.exit(1)
+
+            headers = "length" if useLength else "markers"
+            resolution = "{}x{}".format(width, height)
+            print("{0:>10} {1:>8} {2:>10.1f} {3:>10.1f} {4:>8.1f}".format(
+                resolution, headers, len(stream) / len(jpgs) / 1024, elapsed / frames * 1e6, len(stream) / elapsed / 1e6))
+            results.append({"case": "{} {}".format(resolution, headers), "us": elapsed / frames * 1e6,
+                            "bytesPerFrame": len(stream) // len(jpgs)})
+    return results
+
+def resultKey(benchmark, result):
+    return benchmark, result['case'], result.get('detections')
+
+def compareBaseline(baselineFile, resultMap) -> 'int':
+    # Number of results that got slower than the baseline by more than the tolerance
+    with open(baselineFile) as infile:
+        baseline = json.load(infile)
+
+    baselineMap = {}
+    for benchmark, results in baseline['results'].items():
+        for result in results:
+            baselineMap[resultKey(benchmark, result)] = result['us']
+
+    regressions = 0
+    print("")
+    print("Compared with {0}, tolerance {1:.0f}%".format(baselineFile, args.tolerance * 100))
+    for benchmark, results in resultMap.items():
+        for result in results:
+            key = resultKey(benchmark, result)
+            if not key in baselineMap:
+                continue
+
+            before = baselineMap[key]
+            change = (result['us'] - before) / before if before > 0 else 0.0
+            if change > args.tolerance:
+                regressions += 1
+                detections = "" if key[2] is None else " {} detections".format(key[2])
+                print("  Slower: {0} {1}{2}: {3:.1f}us -> {4:.1f}us ({5:+.0f}%)".format(
+                    benchmark, key[1], detections, before, result['us'], change * 100))
+
+    if regressions == 0:
+        print("  No regressions")
+    return regressions
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--iterations", dest="iterations", type=int, default=200, help="Timed calls per detection count")
+parser.add_argument("-r", "--repeat", dest="repeat", type=int, default=3, help="Timed runs, the fastest is reported")
+parser.add_argument("-s", "--seed", dest="seed", type=int, default=1, help="Seed for the synthetic detections and configs")
+parser.add_argument("-b", "--benchmarks", dest="benchmarks", default=",".join(BENCHMARKS),
+                    help="Comma separated benchmarks to run, from {}".format(", ".join(BENCHMARKS)))
+parser.add_argument("--notifications", dest="notifications", type=int, default=50, help="Notifications in the rules config")
+parser.add_argument("--polygons", dest="polygons", type=int, default=20, help="Polygons in the rules config")
+parser.add_argument("-o", "--output", dest="output", help="Write the results to this JSON file")
+parser.add_argument("--baseline", dest="baseline", help="JSON results of an earlier run to compare with, exits 1 on a regression")
+parser.add_argument("--tolerance", dest="tolerance", type=float, default=0.25,
+                    help="Fraction slower than the baseline that counts as a regression")
+parser.add_argument("sizes", nargs="*", type=int, default=[0, 10, 50, 100, 200, 500], help="Detection counts to benchmark")
+args = parser.parse_args()
+
+benchmarks = args.benchmarks.split(",")
+for benchmark in benchmarks:
+    if not benchmark in BENCHMARKS:
+        print("Unknown benchmark \"{}\", use {}".format(benchmark, ", ".join(BENCHMARKS)))
+        sys.exit(1)
+
+if args.iterations < 1 or args.repeat < 1:
+    print("The iterations and repeat must be at least 1")
+    sys.exit(1)
+
+secure = None
+if "rules" in benchmarks or "resultCache" in benchmarks:
+    secure = loadSecure()
+
+resultMap = {}
+for benchmark in benchmarks:
+    print("")
+    print("{}:".format(benchmark))
+
+    # Every benchmark has its own generator so running a few of them times the same data as running all
+    rng = random.Random(args.seed)
+    if benchmark == "isContained":
+        resultMap[benchmark] = benchIsContained(args.sizes, rng)
+    elif benchmark == "rules":
+        resultMap[benchmark] = benchRules(secure, args.sizes, rng)
+    elif benchmark == "resultCache":
+        resultMap[benchmark] = benchResultCache(secure, args.sizes, rng)
+    elif benchmark == "mjpeg":
+        resultMap[benchmark] = benchMjpeg(rng)
+
+if args.output is not None:
+    with open(args.output, "w") as outfile:
+        json.dump({"time": time.time(), "python": platform.python_version(), "machine": platform.machine(),
+                   "numpy": np.__version__, "iterations": args.iterations, "repeat": args.repeat, "seed": args.seed,
+                   "results": resultMap}, outfile, indent=2)
+
+if args.baseline is not None and compareBaseline(args.baseline, resultMap) > 0:
+    sys.exit(1)
@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+
+# Copyright, 2026, Kim Hendrikse
+
+# Serves a directory of jpegs as MJPEG camera streams, multipart/x-mixed-replace like the cameras
+# sbts-secure reads. Every path is a camera, so http://host:port/cam1 and http://host:port/cam2 are
+# two streams, and any number of clients can read at once. Frames can be sent with jitter, cut short
+# and connections dropped to see how the readers cope. GET /stats returns what has been sent.
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+import cv2
+import numpy as np
+from aiohttp import web
+
+from multi_secureparse.replay import replayFileList
+
+BOUNDARY = "sbtsframe"
+
+def parseResolution(resolution):
+    try:
+        width, height = resolution.lower().split("x")
+        return int(width), int(height)
+    except ValueError:
+        print("The resolution must be given as WIDTHxHEIGHT, for example 1920x1080")
+        sys.exit(1)
+
+def loadFrames(directory, resolution, quality):
+    # Frames are decoded and encoded again only when they have to be resized, and only once at startup
+    frames = []
+    for filename in replayFileList(directory):
+        with open(filename, "rb") as infile:
+            jpg = infile.read()
+
+        if resolution is not None:
+            image = cv2.imdecode(np.frombuffer(jpg, np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                print("Skipping {}, it can't be decoded".format(filename))
+                continue
+            if (image.shape[1], image.shape[0]) != resolution:
+                image = cv2.resize(image, resolution, interpolation=cv2.INTER_AREA)
+                jpg = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+        frames.append(jpg)
+    return frames
+
+def generateFrames(count, resolution, quality, seed):
+    # A noisy scene with a box moving across it, so the jpegs are about as large as a real camera's
+    width, height = resolution
+    rng = np.random.RandomState(seed)
+    background = cv2.GaussianBlur(rng.randint(0, 256, (height, width, 3), dtype=np.uint8), (5, 5), 0)
+
+    frames = []
+    for i in range(count):
+        image = background.copy()
+        x = int(i * (width - width // 8) / max(1, count - 1))
+        y = height // 3
+        cv2.rectangle(image, (x, y), (x + width // 8, y + height // 3), (40, 40, 200), -1)
+        cv2.putText(image, "frame {}".format(i), (20, 60), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        frames.append(cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes())
+    return frames
+
+def makePart(jpg):
+    headers = "--{}\r\nContent-Type: image/jpeg\r\n".format(BOUNDARY)
+    if not args.no_length:
+        headers += "Content-Length: {}\r\n".format(len(jpg))
+    return headers.encode("latin-1") + b"\r\n" + jpg + b"\r\n"
+
+class StreamStats():
+    # What has been sent on every camera path, for GET /stats
+    def __init__(self):
+        self.clients = 0
+        self.connections = 0
+        self.frames = 0
+        self.bytes = 0
+        self.truncated = 0
+        self.disconnects = 0
+
+    def toJson(self):
+        return {"clients": self.clients, "connections": self.connections, "frames": self.frames,
+                "bytes": self.bytes, "truncated": self.truncated, "disconnects": self.disconnects}
+
+async def streamCamera(request):
+    name = request.match_info['cam']
+    if not name in statsMap:
+        statsMap[name] = StreamStats()
+    stats = statsMap[name]
+
+    response = web.StreamResponse(headers={'Content-Type': 'multipart/x-mixed-replace; boundary={}'.format(BOUNDARY),
+                                           'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+
+    stats.clients += 1
+    stats.connections += 1
+
+    # Clients start at different frames like cameras that were switched on at different times
+    rng = random.Random("{}-{}-{}".format(args.seed, name, stats.connections))
+    index = rng.randrange(len(frames))
+    interval = 1.0 / args.fps
+    jitter = args.jitter / 1000.0
+    nextTime = time.monotonic()
+
+    try:
+        while True:
+            jpg = frames[index]
+            index = (index + 1) % len(frames)
+
+            if rng.random() < args.truncate_rate:
+                # The part length matches what is sent, the jpeg in it just has no end
+                jpg = jpg[:rng.randint(2, len(jpg) - 1)]
+                stats.truncated += 1
+
+            part = makePart(jpg)
+            await response.write(part)
+            stats.frames += 1
+            stats.bytes += len(part)
+
+            if rng.random() < args.disconnect_rate:
+                if debug:
+                    print("Dropping a client of \"{}\"".format(name))
+                stats.disconnects += 1
+                break
+
+            # Keep to the frame rate on average, a late frame doesn't make the next ones late
+            nextTime += interval
+            delay = nextTime - time.monotonic()
+            if jitter > 0:
+                delay += rng.uniform(-jitter, jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -1.0:
+                nextTime = time.monotonic()
+    except (ConnectionResetError, asyncio.CancelledError):
+        pass
+    finally:
+        stats.clients -= 1
+
+    # Dropped without the closing boundary, like a camera that went away
+    if request.transport is not None:
+        request.transport.close()
+    return response
+
+async def reportStats(request):
+    return web.Response(text=json.dumps({name: stats.toJson() for name, stats in statsMap.items()}, indent=2),
+                        headers={'Content-Type': 'text/json'})
+
+async def startServer():
+    app = web.Application()
+    app.router.add_get('/stats', reportStats)
+    app.router.add_get('/{cam}', streamCamera)
+    runner = web.AppRunner(app)
+    await runner.setup()
+
+    site = web.TCPSite(runner, args.bind_address, int(args.server_port))
+    await site.start()
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-b", "--bind", dest="bind_address", help="Bind address for the server")
+parser.add_argument("-p", "--port", dest="server_port", help="Port for the server")
+parser.add_argument("-d", "--debug", action="store_true", help="Enable debug output")
+parser.add_argument("-i", "--images", dest="images", help="Directory of jpegs to stream, generated frames are streamed without it")
+parser.add_argument("-r", "--resolution", dest="resolution",
+                    help="WIDTHxHEIGHT to resize the jpegs to, generated frames default to 1920x1080")
+parser.add_argument("-q", "--quality", dest="quality", type=int, default=80, help="JPEG quality of resized or generated frames")
+parser.add_argument("--frames", dest="frames", type=int, default=50, help="Number of frames to generate")
+parser.add_argument("-f", "--fps", dest="fps", type=float, default=10.0, help="Frames per second sent to each client")
+parser.add_argument("-j", "--jitter", dest="jitter", type=float, default=0.0, help="Milliseconds a frame may be sent early or late")
+parser.add_argument("-s", "--seed", dest="seed", type=int, default=1, help="Seed for the jitter, truncated frames and disconnects")
+parser.add_argument("--truncate-rate", dest="truncate_rate", type=float, default=0.0, help="Fraction of frames cut short")
+parser.add_argument("--disconnect-rate", dest="disconnect_rate", type=float, default=0.0,
+                    help="Fraction of frames after which the client is disconnected")
+parser.add_argument("--no-length", dest="no_length", action="store_true",
+                    help="Leave Content-Length out of the part headers so readers have to scan for the jpeg markers")
+args = parser.parse_args()
+
+if args.bind_address == None or args.server_port == None:
+    print("You must supply both a server bind host address and port")
+    sys.exit(1)
+
+if args.fps <= 0:
+    print("The frame rate must be above 0")
+    sys.exit(1)
+
+debug = args.debug
+
+resolution = None
+if args.resolution is not None:
+    resolution = parseResolution(args.resolution)
+
+if args.images is not None:
+    frames = loadFrames(args.images, resolution, args.quality)
+else:
+    frames = generateFrames(args.frames, resolution or (1920, 1080), args.quality, args.seed)
+
+if len(frames) == 0:
+    print("No frames to stream")
+    sys.exit(1)
+
+print("Streaming {} frames of about {} bytes at {} fps".format(len(frames), sum(len(jpg) for jpg in frames) // len(frames), args.fps))
+
+statsMap = {}
+
+asyncio.get_event_loop().run_until_complete(startServer())
+asyncio.get_event_loop().run_forever()
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+# Copyright, 2026, Kim Hendrikse
+
+# A stand-in for the model servers that needs no weights or GPU. It speaks the same websocket protocol
+# as sbts-yolov7-server.py and answers with detections from a fixture file or generated from a seed,
+# after an artificial latency and with optional slow replies and closed connections.
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+
+import numpy as np
+import websockets
+
+from multi_secureparse.protocol import RESULT_HEADER, RESULT_MAGIC, RESULT_RECORD, FORMAT_JSON, FORMAT_BINARY
+
+def loadFixture(filename):
+    # Either one list of detections used for every frame, or a list of them used in turn frame by frame
+    with open(filename) as infile:
+        fixture = json.load(infile)
+
+    # A detection is never empty and starts with its name, so an empty first element is a frame without
+    # detections and one starting with a list is a frame's detections
+    if len(fixture) > 0 and (len(fixture[0]) == 0 or isinstance(fixture[0][0], list)):
+        return fixture
+    return [fixture]
+
+def generateDetections(rng):
+    detections = []
+    for i in range(rng.randint(0, args.max_detections)):
+        w = rng.uniform(10, args.width / 4)
+        h = rng.uniform(20, args.height / 2)
+        detections.append([rng.choice(names), round(rng.uniform(0.2, 1.0), 4),
+                           [rng.uniform(0, args.width), rng.uniform(0, args.height), w, h]])
+    return detections
+
+def latency(rng):
+    # Seconds to wait before replying, drawn from the chosen distribution around --latency
+    mean = args.latency / 1000.0
+    jitter = args.jitter / 1000.0
+    if args.distribution == "uniform":
+        delay = rng.uniform(mean - jitter, mean + jitter)
+    elif args.distribution == "normal":
+        delay = rng.gauss(mean, jitter)
+    elif args.distribution == "exponential":
+        delay = rng.expovariate(1.0 / mean) if mean > 0 else 0.0
+    else:
+        delay = mean
+
+    if rng.random() < args.slow_rate:
+        delay += args.slow / 1000.0
+
+    return max(0.0, delay)
+
+def resultJson(detections):
+    return json.dumps(detections)
+
+def resultBinary(detections):
+    records = np.empty(len(detections), dtype=RESULT_RECORD)
+    for i, item in enumerate(detections):
+        records[i] = (nameIndex[item[0]], item[1], item[2][:4])
+    return RESULT_HEADER.pack(RESULT_MAGIC, len(records)) + records.tobytes()
+
+def helloReply(message):
+    try:
+        hello = json.loads(message)['hello']
+    except Exception:
+        hello = {}
+
+    resultFormat = FORMAT_JSON
+    if hello.get('format') == FORMAT_BINARY:
+        resultFormat = FORMAT_BINARY
+
+    classes = None
+    if hello.get('classes') is not None:
+        classes = set(hello['classes'])
+
+    return {"format": resultFormat, "names": names}, classes
+
+async def server_me(websocket, path=None):
+    global connectionCount
+
+    # Every connection gets its own generator so a run with the same seed replies the same way
+    connectionCount += 1
+    rng = random.Random(args.seed * 1000003 + connectionCount)
+    binary = False
+    classes = None
+    frameCount = 0
+
+    while True:
+        try:
+            blob_data = await websocket.recv()
+        except websockets.ConnectionClosed:
+            break
+
+        if isinstance(blob_data, str):
+            reply, classes = helloReply(blob_data)
+            binary = reply['format'] == FORMAT_BINARY
+            await websocket.send(json.dumps(reply))
+            continue
+
+        if fixture is not None:
+            detections = fixture[frameCount % len(fixture)]
+        else:
+            detections = generateDetections(rng)
+        frameCount += 1
+
+        if classes is not None:
+            detections = [item for item in detections if item[0] in classes]
+
+        # Stands in for inference, one frame at a time per --concurrency like a single GPU
+        async with inferenceSlots:
+            await asyncio.sleep(latency(rng))
+
+        if rng.random() < args.close_rate:
+            if debug:
+                print("Closing connection {} instead of replying".format(connectionCount))
+            await websocket.close()
+            break
+
+        if debug:
+            print("{0}".format(detections))
+
+        if binary:
+            await websocket.send(resultBinary(detections))
+        else:
+            await websocket.send(resultJson(detections))
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-b", "--bind", dest="bind_address", help="Bind address for the server")
+parser.add_argument("-p", "--port", dest="server_port", help="Port for the server")
+parser.add_argument("-d", "--debug", action="store_true", help="Enable debug output")
+parser.add_argument("-f", "--fixture", dest="fixture", help="JSON file of detections to reply with instead of generated ones")
+parser.add_argument("-s", "--seed", dest="seed", type=int, default=1, help="Seed for generated detections, latencies and failures")
+parser.add_argument("--names", dest="names", default="person,car,bicycle,dog,cat", help="Comma separated class names")
+parser.add_argument("--max-detections", dest="max_detections", type=int, default=10, help="Most detections generated per frame")
+parser.add_argument("--width", dest="width", type=int, default=1920, help="Frame width generated boxes fall in")
+parser.add_argument("--height", dest="height", type=int, default=1080, help="Frame height generated boxes fall in")
+parser.add_argument("--latency", dest="latency", type=float, default=20.0, help="Mean reply latency in milliseconds")
+parser.add_argument("--jitter", dest="jitter", type=float, default=0.0, help="Latency spread in milliseconds")
+parser.add_argument("--distribution", dest="distribution", choices=["fixed", "uniform", "normal", "exponential"],
+                    default="fixed", help="Distribution latencies are drawn from")
+parser.add_argument("--concurrency", dest="concurrency", type=int, default=1, help="Frames that can be in inference at once")
+parser.add_argument("--slow-rate", dest="slow_rate", type=float, default=0.0, help="Fraction of replies that are slow")
+parser.add_argument("--slow", dest="slow", type=float, default=1000.0, help="Extra milliseconds a slow reply takes")
+parser.add_argument("--close-rate", dest="close_rate", type=float, default=0.0,
+                    help="Fraction of frames answered by closing the connection")
+args = parser.parse_args()
+
+if args.bind_address == None or args.server_port == None:
+    print("You must supply both a server bind host address and port")
+    sys.exit(1)
+
+if args.concurrency < 1:
+    print("The concurrency must be at least 1")
+    sys.exit(1)
+
+debug = args.debug
+
+fixture = None
+if args.fixture is not None:
+    fixture = loadFixture(args.fixture)
+
+# Fixture names come first so binary class ids stay the same whatever --names says
+names = []
+for frameDetections in (fixture or []):
+    for item in frameDetections:
+        if not item[0] in names:
+            names.append(item[0])
+for name in args.names.split(","):
+    if name != "" and not name in names:
+        names.append(name)
+nameIndex = {name: i for i, name in enumerate(names)}
+
+connectionCount = 0
+inferenceSlots = asyncio.Semaphore(args.concurrency)
+
+async def startServer():
+    return await websockets.serve(server_me, args.bind_address, args.server_port)
+
+asyncio.get_event_loop().run_until_complete(startServer())
+asyncio.get_event_loop().run_forever()
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+# Copyright, 2026, Kim Hendrikse
+
+# Measures how many frames CameraReader gets through and the CPU it takes as the number of cameras
+# grows. The streams come from sbts-camera-sim.py, run it in another process so its CPU isn't counted:
+#
+#   ./sbts-camera-sim.py -b 127.0.0.1 -p 18080 -r 1920x1080 -f 10
+#   ./sbts-ingest-benchmark.py -u http://127.0.0.1:18080 -c 1,8,32,64
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import sys
+import time
+
+import aiohttp
+import requests
+
+from multi_secureparse.model import CameraReader, DEFAULT_CHUNK_SIZE
+
+def simulatorStats():
+    response = requests.get(args.url + "/stats", timeout=5)
+    return response.json()
+
+def framesSent(statsMap, names):
+    return sum(statsMap[name]['frames'] for name in names if name in statsMap)
+
+def connectionCount(statsMap, names):
+    return sum(statsMap[name]['connections'] for name in names if name in statsMap)
+
+def frameCounts(cameras):
+    received = 0
+    dropped = 0
+    for camera in cameras:
+        cameraReceived, cameraDropped = camera.getFrameCounts()
+        received += cameraReceived
+        dropped += cameraDropped
+    return received, dropped
+
+async def consume(camera, consumed):
+    # Takes frames the way the camera runners in sbts-secure do, without processing them
+    while True:
+        await camera.waitForImage()
+        consumed[camera.getName()] += 1
+
+async def runCameras(ingest, cameraCount):
+    loop = asyncio.get_event_loop()
+    names = ["{}-{}-{}".format(ingest, cameraCount, i) for i in range(cameraCount)]
+    cameras = []
+    for name in names:
+        camera = CameraReader(name, "{}/{}".format(args.url, name), "", "", {}, [], True, chunkSize=args.chunk_size)
+        camera.attachLoop(loop)
+        cameras.append(camera)
+
+    session = None
+    readers = []
+    if ingest == "aiohttp":
+        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60))
+        for camera in cameras:
+            readers.append(camera.startAsync(session))
+    else:
+        for camera in cameras:
+            # Readers are left to finish on their own once disabled
+            camera.daemon = True
+            camera.start()
+
+    consumed = {name: 0 for name in names}
+    consumers = [asyncio.ensure_future(consume(camera, consumed)) for camera in cameras]
+
+    # Give every stream time to connect before measuring
+    await asyncio.sleep(args.warmup)
+
+    startStats = simulatorStats()
+    startReceived, startDropped = frameCounts(cameras)
+    startConsumed = sum(consumed.values())
+    startCpu = time.process_time()
+    startTime = time.monotonic()
+
+    await asyncio.sleep(args.duration)
+
+    elapsed = time.monotonic() - startTime
+    cpu = time.process_time() - startCpu
+    endReceived, endDropped = frameCounts(cameras)
+    endConsumed = sum(consumed.values())
+    endStats = simulatorStats()
+
+    for camera in cameras:
+        camera.disable()
+    for task in consumers + readers:
+        task.cancel()
+    await asyncio.gather(*(consumers + readers), return_exceptions=True)
+    if session is not None:
+        await session.close()
+
+    received = endReceived - startReceived
+    return {"ingest": ingest,
+            "cameras": cameraCount,
+            "seconds": round(elapsed, 3),
+            "sentFps": (framesSent(endStats, names) - framesSent(startStats, names)) / elapsed,
+            "receivedFps": received / elapsed,
+            "consumedFps": (endConsumed - startConsumed) / elapsed,
+            "dropped": endDropped - startDropped,
+            "reconnects": connectionCount(endStats, names) - connectionCount(startStats, names),
+            "cpuPercent": 100.0 * cpu / elapsed,
+            "cpuPercentPerCamera": 100.0 * cpu / elapsed / cameraCount,
+            "cpuMsPerFrame": 1000.0 * cpu / received if received > 0 else None}
+
+async def runBenchmark():
+    results = []
+    if not args.json:
+        print("{0:>8} {1:>8} {2:>10} {3:>10} {4:>10} {5:>8} {6:>8} {7:>12} {8:>12}".format(
+            "ingest", "cameras", "sent fps", "recv fps", "used fps", "dropped", "cpu %", "cpu %/camera", "cpu ms/frame"))
+
+    for ingest in args.ingest.split(","):
+        for cameraCount in [int(count) for count in args.cameras.split(",")]:
+            if args.debug:
+                result = await runCameras(ingest, cameraCount)
+            else:
+                # The readers print every connect and disconnect
+                with contextlib.redirect_stdout(io.StringIO()):
+                    result = await runCameras(ingest, cameraCount)
+            results.append(result)
+
+            if not args.json:
+                print("{0:>8} {1:>8} {2:>10.1f} {3:>10.1f} {4:>10.1f} {5:>8} {6:>8.1f} {7:>12.2f} {8:>12}".format(
+                    ingest, cameraCount, result['sentFps'], result['receivedFps'], result['consumedFps'], result['dropped'],
+                    result['cpuPercent'], result['cpuPercentPerCamera'],
+                    "n/a" if result['cpuMsPerFrame'] is None else "{0:.3f}".format(result['cpuMsPerFrame'])))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-d", "--debug", action="store_true", help="Show the output of the camera readers")
+parser.add_argument("-u", "--url", dest="url", default="http://127.0.0.1:18080", help="Base url of sbts-camera-sim.py")
+parser.add_argument("-c", "--cameras", dest="cameras", default="1,2,4,8,16,32", help="Comma separated camera counts to run")
+parser.add_argument("-i", "--ingest", dest="ingest", default="thread,aiohttp", help="Comma separated ingest modes, thread and aiohttp")
+parser.add_argument("-t", "--duration", dest="duration", type=float, default=10.0, help="Seconds measured per camera count")
+parser.add_argument("-w", "--warmup", dest="warmup", type=float, default=2.0, help="Seconds to connect before measuring")
+parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=DEFAULT_CHUNK_SIZE, help="Bytes read from a stream at a time")
+parser.add_argument("--json", dest="json", action="store_true", help="Print the results as JSON")
+args = parser.parse_args()
+
+args.url = args.url.rstrip("/")
+
+for ingest in args.ingest.split(","):
+    if not ingest in ["thread", "aiohttp"]:
+        print("Unknown ingest mode \"{}\", use thread or aiohttp".format(ingest))
+        sys.exit(1)
+
+try:
+    simulatorStats()
+except Exception as e:
+    print("Can't reach the camera simulator at {}: {}".format(args.url, str(e)))
+    sys.exit(1)
+
+asyncio.get_event_loop().run_until_complete(runBenchmark())
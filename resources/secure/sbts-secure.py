@@ -3,63 +3,131 @@
 # Copyright, 2021, Kim Hendrikse
 
 import asyncio
+import aiohttp
 from aiohttp import web
 import json
 import sys
 import os
+import time
 
 import argparse
-import requests
 
-import websockets
+import numpy as np
 
-from multi_secureparse.model import SecureConfig, CameraReader, Notify, ModelMap
+from multi_secureparse.model import SecureConfig, CameraReader, Notify, ModelMap, Detections
+from multi_secureparse.protocol import decodeRecords
+from multi_secureparse.modelpool import ModelReplica, ModelConnectionPool, ModelUnavailable
+from multi_secureparse.notifier import NotificationDispatcher
+from multi_secureparse.plan import Predicate
+from multi_secureparse.roi import RoiFrame
+from multi_secureparse.metrics import REGISTRY, Counter, Histogram, Collected
+from multi_secureparse.modelpool import MODEL_WAIT, MODEL_ROUND_TRIP
+from multi_secureparse.replay import replayFileList, replayDirectory, NotificationLog
+from multi_secureparse.trace import Tracer
+
+FRAMES_PROCESSED = Counter("sbts_frames_processed_total", "Frames run through the models and rules", ("camera",))
+FRAME_AGE = Histogram("sbts_frame_age_seconds", "Time from the last byte of a frame arriving to it being processed", ("camera",))
+RULE_TIME = Histogram("sbts_rule_evaluation_seconds", "Time evaluating the notifications of a camera for one frame",
+                      ("camera",))
 
 class ResultCache():
-    def __init__(self, wsMap):
+    def __init__(self, wsMap, roiFrame:RoiFrame = None, trace=None):
         self.wsMap = wsMap
-        self.cachedResult = {}
+        self.roiFrame = roiFrame
+        self.trace = trace
         self.categoryMap = {}
+        self.countMap = {}
+        self.unavailable = set()
         self.advanceSkip = False
         self.fired = False
 
-    async def fetch(self, ws, modelName, image):
+    def decode(self, replica, r):
+        # Class ids, the names they index, probabilities and x, y, w, h boxes of a model's reply
+        if isinstance(r, bytes):
+            records = decodeRecords(r)
+            return records['cls'], replica.getNames(), records['conf'], records['box']
+
+        resultJson = json.loads(r)
+        if len(resultJson) == 0:
+            return np.zeros(0, dtype=int), [], np.zeros(0), np.zeros((0, 4))
+
+        names, classIds = np.unique([item[0] for item in resultJson], return_inverse=True)
+        return classIds, names.tolist(), np.array([item[1] for item in resultJson]),\
+            np.array([item[2][:4] for item in resultJson])
+
+    async def fetch(self, pool, modelName, image):
+        # Optionally only the region of interest is sent, scaled to the model's input size
+        transform = None
+        if self.roiFrame is not None:
+            # Decoding, cropping and encoding would hold up every camera if done in the event loop
+            image, transform = await asyncio.get_event_loop().run_in_executor(None, self.roiFrame.forModel, pool.getInputSize())
+
+        # Sent to the least busy replica of the model, and to another one if that fails
         try:
-            await ws.send(image)
-            r = await ws.recv()
-            resultJson = json.loads(r)
-            self.cachedResult[modelName] = resultJson
+            replica, r = await pool.request(image, self.trace)
+        except ModelUnavailable:
+            self.unavailable.add(modelName)
+            self.categoryMap[modelName] = {}
+            return self.categoryMap[modelName]
 
-            # Construct map by category of matches
-            if not modelName in self.categoryMap.keys():
-                self.categoryMap[modelName] = {}
-
-            for el in resultJson:
-                if el[0] not in self.categoryMap[modelName].keys():
-                    self.categoryMap[modelName][el[0]] = []
-                self.categoryMap[modelName][el[0]].append(el)
-
-            return resultJson
-        except websockets.ConnectionClosed as e:
-            print("Websocket closed exception, aborting: {0}, err: {1}".format(type(e).__name__, str(e)))
-            os._exit(1)
-
-    async def getResult(self, modelName, image):
-        ws = self.wsMap[modelName]
-        if modelName in self.cachedResult.keys():
-            return self.cachedResult[modelName]
-        else:
-            return await self.fetch(ws, modelName, image)
+        classIds, names, probs, boxes = self.decode(replica, r)
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+        # Detections from a region of interest are moved back to where they are in the whole frame
+        if transform is not None:
+            boxes = transform.mapBack(boxes)
+
+        # Construct map by category of matches
+        self.categoryMap[modelName] = {}
+        for classId in np.unique(classIds).tolist():
+            mask = classIds == classId
+            category = names[classId]
+            self.categoryMap[modelName][category] = Detections(category, probs[mask], boxes[mask])
+
+        return self.categoryMap[modelName]
 
     async def getResult(self, modelName, category, image):
-        ws = self.wsMap[modelName]
+        return (await self.getDetections(modelName, category, image)).getItems()
+
+    async def getDetections(self, modelName, category, image) -> 'Detections':
+        # Built once per frame for each model and shared by every model entry that uses them
         if not modelName in self.categoryMap.keys():
-            await self.fetch(ws, modelName, image)
+            await self.fetch(self.wsMap[modelName], modelName, image)
 
-        if category in self.categoryMap[modelName].keys():
-            return self.categoryMap[modelName][category]
-        else:
-            return []
+        if not category in self.categoryMap[modelName].keys():
+            self.categoryMap[modelName][category] = Detections(category, [], [])
+        return self.categoryMap[modelName][category]
+
+    async def getCount(self, predicate:Predicate, image):
+        # Each predicate of the rule plan is only evaluated once per frame however many notifications,
+        # zones and excludes use it
+        if not predicate in self.countMap.keys():
+            detections = await self.getDetections(predicate.getModelName(), predicate.getCategory(), image)
+            containedMask = predicate.getModel().containedMask(detections)
+            self.countMap[predicate] = int(containedMask.sum())
+
+            if debug:
+                for item, contained in zip(detections.getItems(), containedMask):
+                    if contained:
+                        print("      {}: matched".format(item))
+                    else:
+                        print("      {}".format(item))
+
+        return self.countMap[predicate]
+
+    def isUnavailable(self, modelNames) -> 'bool':
+        # True when one of the models had no server to answer for this frame
+        return not self.unavailable.isdisjoint(modelNames)
+
+    async def prefetch(self, modelNames, image):
+        # Send the frame to every model that is needed at the same time rather than one after the other
+        fetchList = []
+        for modelName in modelNames:
+            if not modelName in self.categoryMap.keys():
+                fetchList.append(self.fetch(self.wsMap[modelName], modelName, image))
+
+        if len(fetchList) > 0:
+            await asyncio.gather(*fetchList)
 
     def getWsList(self):
         return self.wsMap
@@ -70,6 +138,34 @@ class ResultCache():
     def getFired(self):
         return self.fired
 
+    def getTrace(self):
+        return self.trace
+
+class FrameAgeStats():
+    # How long frames waited between arriving from the camera and being processed
+    def __init__(self):
+        self.processed = 0
+        self.totalAge = 0.0
+        self.maxAge = 0.0
+        self.lastAge = 0.0
+
+    def record(self, age):
+        self.processed += 1
+        self.totalAge += age
+        self.lastAge = age
+        if age > self.maxAge:
+            self.maxAge = age
+
+    def toJson(self):
+        meanAge = 0.0
+        if self.processed > 0:
+            meanAge = self.totalAge / self.processed
+
+        return {"processed": self.processed,
+                "lastAge": round(self.lastAge, 6),
+                "meanAge": round(meanAge, 6),
+                "maxAge": round(self.maxAge, 6)}
+
 class ReturnResult():
     def __init__(self):
         self.triggered = False
@@ -107,11 +203,81 @@ async def reportnotifyState(request):
         notifyEnabledMap[cam] = {}
         notifyEnabledMap[cam]['enabled'] = cameraMap[cam].isEnabled()
         notifyEnabledMap[cam]['notifications'] = {}
+        notifyEnabledMap[cam]['notificationCounters'] = {}
         for notify in cameraMap[cam].getNotifyList():
             notifyEnabledMap[cam]['notifications'][notify.getName()] = notify.isEnabled()
+            notifyEnabledMap[cam]['notificationCounters'][notify.getName()] = notify.getCounters()
 
     return web.Response(text=json.dumps(notifyEnabledMap, indent=2), headers={'Content-Type': 'text/json'})
 
+def collectCameraCounts(index):
+    return {(cam,): camera.getFrameCounts()[index] for cam, camera in cameraMap.items()}
+
+def collectMotionSkipped():
+    return {(cam,): camera.getMotionGate().toJson()['skipped'] for cam, camera in cameraMap.items()
+            if camera.getMotionGate() is not None}
+
+def collectNotifyCounts():
+    counts = {}
+    for cam, camera in cameraMap.items():
+        for notify in camera.getNotifyList():
+            for result, count in notify.getCounters().items():
+                if result != "lastFired":
+                    counts[(cam, notify.getName(), result)] = count
+    return counts
+
+def collectDeliveries():
+    counts = {}
+    for url, endpointStats in notificationDispatcher.getStatsMap().items():
+        for result, count in endpointStats.toJson().items():
+            counts[(url, result)] = count
+    return counts
+
+def collectReplicas(key):
+    values = {}
+    for modelName, pool in modelPoolMap.items():
+        for url, replicaJson in pool.toJson().items():
+            values[(modelName, url)] = int(replicaJson[key])
+    return values
+
+def registerCollectedMetrics():
+    # Counts that are already kept for /stats, read when the metrics are scraped
+    Collected("sbts_frames_received_total", "Frames received from the camera", "counter", ("camera",),
+              lambda: collectCameraCounts(0))
+    Collected("sbts_frames_dropped_total", "Frames replaced by a newer one before they were processed", "counter",
+              ("camera",), lambda: collectCameraCounts(1))
+    Collected("sbts_frames_motion_skipped_total", "Frames the motion gate kept from the models", "counter", ("camera",),
+              collectMotionSkipped)
+    Collected("sbts_notifications_total", "Notifications by what happened when they matched", "counter",
+              ("camera", "notification", "result"), collectNotifyCounts)
+    Collected("sbts_notification_deliveries_total", "Notification deliveries by outcome", "counter", ("url", "result"),
+              collectDeliveries)
+    Collected("sbts_model_replica_healthy", "1 while a model server replica is connected", "gauge", ("model", "url"),
+              lambda: collectReplicas("healthy"))
+    Collected("sbts_model_replica_failures_total", "Times a model server replica failed", "counter", ("model", "url"),
+              lambda: collectReplicas("failures"))
+
+async def reportMetrics(request):
+    return web.Response(text=REGISTRY.render(), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+async def reportStats(request):
+    statsMap = {'cameras': {}}
+    for cam in cameraMap.keys():
+        statsMap['cameras'][cam] = {}
+        statsMap['cameras'][cam]['frameAge'] = frameAgeMap[cam].toJson()
+        if cameraMap[cam].getMotionGate() is not None:
+            statsMap['cameras'][cam]['motionGate'] = cameraMap[cam].getMotionGate().toJson()
+
+    statsMap['models'] = {}
+    for modelName, pool in modelPoolMap.items():
+        statsMap['models'][modelName] = pool.toJson()
+
+    statsMap['notificationEndpoints'] = {}
+    for url, endpointStats in notificationDispatcher.getStatsMap().items():
+        statsMap['notificationEndpoints'][url] = endpointStats.toJson()
+
+    return web.Response(text=json.dumps(statsMap, indent=2), headers={'Content-Type': 'text/json'})
+
 async def changeNotifyState(request):
     cam = request.match_info.get('cam', "")
     notification = request.match_info.get('notification', "")
@@ -142,6 +308,8 @@ async def webServer():
     app = web.Application()
     # app.router.add_get('/', handle)
     app.router.add_post('/enabled', reportnotifyState)
+    app.router.add_post('/stats', reportStats)
+    app.router.add_get('/metrics', reportMetrics)
     app.router.add_post('/notify/{op}/{cam}/{notification}', changeNotifyState)
     app.router.add_post('/cam/{op}/{cam}', changeCameraState)
     runner = web.AppRunner(app)
@@ -150,20 +318,31 @@ async def webServer():
     site = web.TCPSite(runner, server_bind_address, server_port)
     await site.start()
 
-def fireNotification(notify:Notify):
+def fireNotification(notify:Notify, camera:CameraReader, trace=None):
     if debug:
         print("    Fired: {}".format(notify.getName()))
-    try:
-        if notify.getMethod() == "POST":
-            requests.post(notify.getUrl(), auth=(notify.getUsername(), notify.getPassword()), data=notify.getParams())
-        else:
-            requests.get(notify.getUrl(), auth=(notify.getUsername(), notify.getPassword()), data=notify.getParams())
-    except Exception as e:
-        print("Caught firing notification: {0}, err: {1}".format(type(e).__name__, str(e)))
+
+    if trace is not None:
+        trace.markFired(notify.getName())
+
+    # A replay only logs what would have been sent
+    if notificationLog is not None:
+        notificationLog.record(notify, camera.getName(), camera.getReplayFrameName())
+        return
+
+    # Queued for delivery in the background, never waits on the endpoint
+    notificationDispatcher.submit(notify, trace)
 
 async def processResult(resultCache, image, returnResult:ReturnResult, camera:CameraReader):
     returnResult.setAdvanceSkip(False)
-    for notify in camera.getNotifyList():
+    rulePlan = camera.getRulePlan()
+
+    # Fan the frame out to all of the models the enabled notifications reference before evaluating the zones
+    await resultCache.prefetch(rulePlan.getModelNames(), image)
+    ruleStart = time.monotonic()
+
+    for notifyPlan in rulePlan.getNotifications():
+        notify = notifyPlan.getNotify()
         returnResult.setTriggered(False)
 
         # Dynamic disable/enable from notifications via rest interface
@@ -171,7 +350,15 @@ async def processResult(resultCache, image, returnResult:ReturnResult, camera:Ca
         if not notify.isEnabled():
             continue
 
-        for zone in notify.getZoneList():
+        # Without all of its models the notification can't be evaluated, it is skipped for this frame
+        # and keeps its firing state
+        if resultCache.isUnavailable(notifyPlan.getModelNames()):
+            notify.markUnavailable()
+            if debug:
+                print("  Skipped {}, a model it uses is unavailable".format(notify.getName()))
+            continue
+
+        for zone in notifyPlan.getZones():
             excluded = False
             if debug:
                 print("  Zone: {}".format(zone.getName()))
@@ -180,7 +367,7 @@ async def processResult(resultCache, image, returnResult:ReturnResult, camera:Ca
             if excluded:
                 break
 
-            for include in zone.getIncludeList():
+            for include in zone.getIncludes():
                 await checkIncluded(image, include, resultCache, returnResult)
 
                 if returnResult.getTriggered():
@@ -190,43 +377,37 @@ async def processResult(resultCache, image, returnResult:ReturnResult, camera:Ca
                 break
 
         if notify.isNegate():
-            if not returnResult.getTriggered():
-                fireNotification(notify)
+            matched = not returnResult.getTriggered()
         else:
-            if returnResult.getTriggered():
-                fireNotification(notify)
+            matched = returnResult.getTriggered()
+
+        # Cooldown and onChange settings decide whether this match is sent or coalesced
+        if notify.shouldFire(matched):
+            fireNotification(notify, camera, resultCache.getTrace())
+
+    ruleEnd = time.monotonic()
+    RULE_TIME.observe(ruleEnd - ruleStart, (camera.getName(),))
+    if resultCache.getTrace() is not None:
+        resultCache.getTrace().span("rules", ruleStart, ruleEnd)
 
 async def checkIncluded(image, include, resultCache, returnResult:ReturnResult):
-    for modelList in include.getModels():
+    for modelList in include.getGroups():
         triggerCount = 0
         skipping = False
-        for model in modelList:
+        for term in modelList:
+            predicate = term.getPredicate()
             if debug:
-                print("    Checking include: {0}, model {1}:{2}".format(include.getName(), model.getName(), model.getCategory()))
-            result = await resultCache.getResult(model.getName(), model.getCategory(), image)
-
-            count = 0
-            minCount = model.getCounter()
-
-            for item in result:
-                prob = item[1]
-                x, y, w, h = item[2][0], item[2][1], item[2][2], item[2][3]
-                if (model.isContained(prob, int(x), int(y), int(w), int(h))):
-                    if debug:
-                        print("      {}: matched".format(item))
-                    count += 1
-                else:
-                    if debug:
-                        print("      {}".format(item))
+                print("    Checking include: {0}, model {1}:{2}".format(include.getName(), predicate.getModelName(), predicate.getCategory()))
+            count = await resultCache.getCount(predicate, image)
 
-            if count < minCount:
+            if count < term.getCounter():
                 # minCount is not reached, not enough hits in the current image for this model
                 break
 
             # At this point, there was a hit for this model
             triggerCount += 1
 
-            if model.getAdvanceSkip():
+            if term.getAdvanceSkip():
                 skipping = True
 
         if len(modelList) > 0 and triggerCount == len(modelList):
@@ -241,31 +422,23 @@ async def checkIncluded(image, include, resultCache, returnResult:ReturnResult):
             break
 
 async def checkExcluded(excluded, image, resultCache, zone):
-    for excludeRegion in zone.getExcludeList():
-        modelsListList = excludeRegion.getModels()
-        for modelList in modelsListList:
-            triggerCount = await checkExcludedInnerModelList(image, modelList, resultCache)
+    for modelList in zone.getExcludeGroups():
+        triggerCount = await checkExcludedInnerModelList(image, modelList, resultCache)
 
-            if len(modelList) > 0 and triggerCount == len(modelList):
-                excluded = True
-                break
+        if len(modelList) > 0 and triggerCount == len(modelList):
+            excluded = True
+            break
     return excluded
 
 async def checkExcludedInnerModelList(image, modelList, resultCache):
     triggerCount = 0
-    for model in modelList:
+    for term in modelList:
+        predicate = term.getPredicate()
         if debug:
-            print("    Checking exclude: model {0}:{1}".format(model.getName(), model.getCategory()))
-        result = await resultCache.getResult(model.getName(), model.getCategory(), image)
+            print("    Checking exclude: model {0}:{1}".format(predicate.getModelName(), predicate.getCategory()))
+        count = await resultCache.getCount(predicate, image)
 
-        count = 0
-        for item in result:
-            prob = item[1]
-            x, y, w, h = item[2][0], item[2][1], item[2][2], item[2][3]
-            if (model.isContained(prob, int(x), int(y), int(w), int(h))):
-                count += 1
-
-        if count < model.getCounter():
+        if count < term.getCounter():
             # minCount is not reached, not enough hits in the current image for this model
             break
 
@@ -286,81 +459,188 @@ def readConfigFile():
 
         return SecureConfig(modelMap.getModelsMap(), cameras)
 
-@asyncio.coroutine
-def secureRunner():
-    # Read the configuration json file
-    secureConfig = readConfigFile()
+async def processCamera(camera:CameraReader, lastImage, wsMap, returnResult:ReturnResult, frameTrace=None):
+    processStart = time.monotonic()
+    age = lastImage.getAge(processStart)
+    frameAgeMap[camera.getName()].record(age)
+    FRAMES_PROCESSED.inc((camera.getName(),))
+    FRAME_AGE.observe(age, (camera.getName(),))
 
-    # Start the camera reader threads and initialise the return result
-    cameras, returnResultMap = startCamerasAndInitReturnResult(secureConfig)
+    if debug:
+        print("Process camera: {0}, frame age {1:.3f}".format(camera.getName(), age))
 
-    # Create websocket connections for the models
-    wsMap = yield from initWebsocketMap(secureConfig)
+    try:
+        image = lastImage.getImage()
+
+        roiFrame = None
+        if camera.isRoiCrop():
+            roiFrame = RoiFrame(image, camera.getRulePlan().getBounds(), camera.getRoiMargin())
+        resultCache = ResultCache(wsMap, roiFrame, frameTrace)
 
-    cameraCount = len(cameras)
-    cameraIndex = 0
-    skipped = False
-    skipCount = 0
+        await processResult(resultCache, image, returnResult, camera)
+    except Exception as e:
+        print("Caught exception: {0}", type(e))
+        os._exit(1)
+
+    # From the last byte of the frame arriving to it being processed, waiting for the camera runner and a worker slot
+    if frameTrace is not None:
+        frameTrace.span("queue wait", lastImage.getArrivalTime(), processStart)
+        tracer.finishFrame(frameTrace)
 
+    if debug:
+        print("")
+
+async def cameraRunner(camera:CameraReader, wsMap, returnResult:ReturnResult, workerSlots):
     while True:
-        camera = cameras[cameraIndex]
-        returnResult = returnResultMap[camera.getName()]
+        # Woken by the reader as soon as a new frame arrives. Cameras queue for the worker slots in the
+        # order their frames arrived
+        lastImage = await camera.waitForImage()
 
-        lastImage = camera.getLastImage()
-        if camera.isEnabled() and lastImage is not None:
-            if debug:
-                print("Process camera: {}".format(camera.getName()))
-            resultCache = ResultCache(wsMap)
+        # Only a replay runs out of frames
+        if lastImage is None:
+            return
 
-            try:
-                skipCount = 0
-                image = lastImage.getImage()
+        if not camera.isEnabled():
+            continue
 
-                yield from processResult(resultCache, image, returnResult, camera)
+        frameTrace = startTrace(camera, lastImage)
+
+        # Frames without motion in the watched polygons are skipped without running the models
+        motionGate = camera.getMotionGate()
+        if motionGate is not None:
+            gateStart = time.monotonic()
+            # Decoding and diffing the frame would hold up every other camera on the loop
+            moved = await asyncio.get_event_loop().run_in_executor(None, motionGate.check, lastImage.getImage())
+            if frameTrace is not None:
+                frameTrace.span("motion gate", gateStart, time.monotonic(), args={"passed": moved})
+            if not moved:
+                if frameTrace is not None:
+                    tracer.finishFrame(frameTrace)
+                continue
+
+        async with workerSlots:
+            await processCamera(camera, lastImage, wsMap, returnResult, frameTrace)
+
+            # Re-visit this camera once before giving up the worker slot if a model asked for it
+            if returnResult.getAdvanceSkip():
+                lastImage = camera.getLastImage()
+                if camera.isEnabled() and lastImage is not None:
+                    await processCamera(camera, lastImage, wsMap, returnResult, startTrace(camera, lastImage))
+
+def startTrace(camera:CameraReader, lastImage):
+    # None unless tracing is on and the frame is sampled
+    if tracer is None:
+        return None
+    return tracer.startFrame(camera.getName(), lastImage)
+
+async def secureRunner():
+    # Read the configuration json file
+    secureConfig = readConfigFile()
 
-                if not skipped and returnResult.getAdvanceSkip():
-                    skipped = True
-                else:
-                    cameraIndex = (cameraIndex + 1) % cameraCount
-                    skipped = False
+    # Camera streams can be read by aiohttp in this event loop rather than by a thread per camera
+    session = None
+    if args.ingest == "aiohttp" and args.replay is None:
+        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60))
 
-            except Exception as e:
-                print("Caught exception: {0}", type(e))
-                os._exit(1)
-        else:
-            skipCount += 1
-            cameraIndex = (cameraIndex + 1) % cameraCount
+    # Start the camera readers and initialise the return result
+    cameras, returnResultMap = startCamerasAndInitReturnResult(secureConfig, session)
+
+    # Create websocket connections for the models
+    wsMap = await initWebsocketMap(secureConfig)
+    modelPoolMap.update(wsMap)
 
-        if skipCount == cameraCount:
-            skipCount = 0
-            yield from asyncio.sleep(0.005)
+    if notificationLog is None:
+        await notificationDispatcher.start()
 
-        if debug:
-            print("")
+    # Bound the number of cameras being processed at the same time, by default every camera can be in flight
+    workerCount = len(cameras)
+    if args.workers is not None:
+        workerCount = args.workers
+    workerSlots = asyncio.Semaphore(workerCount)
+
+    # Each camera gets its own task so the model servers are kept busy with frames from other cameras
+    # while one camera's results are being evaluated
+    runners = []
+    for camera in cameras:
+        runners.append(cameraRunner(camera, wsMap, returnResultMap[camera.getName()], workerSlots))
+
+    replayStart = time.monotonic()
+    await asyncio.gather(*runners)
+
+    # The runners only finish when a replay has been processed to the end
+    if args.replay is not None:
+        reportReplay(cameras, time.monotonic() - replayStart)
+        notificationLog.close()
+    if tracer is not None:
+        print("Traced {} frames to {}".format(tracer.getFrameCount(), args.trace))
+        tracer.close()
+    os._exit(0)
+
+def printTimings(title, histogram):
+    for labelValues, summary in sorted(histogram.summary().items()):
+        print("  {0:<40} {1:>8} {2:>10.2f} {3:>10} {4:>10}".format(
+            "{} {}".format(title, " ".join(labelValues)), summary['count'], summary['mean'] * 1000,
+            "n/a" if summary['p50'] is None else "<={}".format(summary['p50'] * 1000),
+            "n/a" if summary['p95'] is None else "<={}".format(summary['p95'] * 1000)))
+
+def reportReplay(cameras, elapsed):
+    processed = 0
+    print("Replay finished in {0:.2f}s".format(elapsed))
+    for camera in cameras:
+        received, dropped = camera.getFrameCounts()
+        cameraProcessed = FRAMES_PROCESSED.get((camera.getName(),))
+        processed += cameraProcessed
+        print("  {0}: {1} frames replayed, {2} processed, {3} dropped".format(camera.getName(), received, cameraProcessed, dropped))
 
+    fps = 0.0
+    if elapsed > 0:
+        fps = processed / elapsed
+    print("Processed {0} frames, {1:.1f} fps, {2} notifications logged".format(processed, fps, notificationLog.getCount()))
 
-def startCamerasAndInitReturnResult(secureConfig):
+    print("  {0:<40} {1:>8} {2:>10} {3:>10} {4:>10}".format("Stage", "count", "mean ms", "p50 ms", "p95 ms"))
+    printTimings("frame age", FRAME_AGE)
+    printTimings("model wait", MODEL_WAIT)
+    printTimings("model round trip", MODEL_ROUND_TRIP)
+    printTimings("rules", RULE_TIME)
+
+
+def startCamerasAndInitReturnResult(secureConfig, session):
     returnResultMap = {}
     cameras = secureConfig.getCameras()
     for camera in cameras:
         if debug:
             print("Reader url = {0}".format(camera.getUrl()))
-        camera.start()
+        camera.attachLoop(asyncio.get_event_loop())
+        if args.replay is not None:
+            camera.startReplay(replayFileList(replayDirectory(args.replay, camera.getName())), args.replay_fps)
+        elif session is not None:
+            camera.startAsync(session)
+        else:
+            camera.start()
         returnResultMap[camera.getName()] = ReturnResult()
+        frameAgeMap[camera.getName()] = FrameAgeStats()
         if debug:
             print("Joined")
         cameraMap[camera.getName()] = camera
     return cameras, returnResultMap
 
 
-def initWebsocketMap(secureConfig):
+async def initWebsocketMap(secureConfig):
     wsMap = {}
+    categoryMap = secureConfig.getCategoryMap()
     for modelName in secureConfig.getModelsMap().keys():
         modelsMap = secureConfig.getModelsMap()
         modelMapJson = modelsMap[modelName]
-        url = modelMapJson['url']
-        ws = yield from websockets.connect(url)
-        wsMap[modelName] = ws
+
+        # Each replica of the model gets one connection per request that may be in flight on it. The format
+        # and the categories wanted are agreed when connecting
+        replicas = []
+        for url in modelMapJson['urls']:
+            replicas.append(ModelReplica(modelName, url, modelMapJson['maxInFlight'], modelMapJson['format'],
+                                         sorted(categoryMap.get(modelName, set()))))
+
+        wsMap[modelName] = ModelConnectionPool(modelName, replicas, modelMapJson['inputSize'], modelMapJson['replyTimeout'])
+        await wsMap[modelName].connect()
     return wsMap
 
 
@@ -371,32 +651,76 @@ def initialize(configFilename, readers):
         for camera in configJson["cameraList"]:
             readers.append(CameraReader.from_json(camera))
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-b", "--bind", dest="bind_address", help="Bind address for the control server")
-parser.add_argument("-p", "--port", dest="server_port", help="Port for the control server")
-parser.add_argument("-d", "--debug", action="store_true", help="Enable debug output")
-parser.add_argument("configFile", help="Path to config file")
-args = parser.parse_args()
-
-if args.bind_address == None or args.server_port == None:
-    print("You must supply both a server bind host address and port")
-    sys.exit(1)
-
-server_bind_address = args.bind_address
-server_port = args.server_port
-
-if args.configFile is None:
-    print("Usage: {0} [-d] -b bind address -p port config-json-file".format(sys.argv[0]))
-    sys.exit(1)
-
-debug = args.debug
+debug = False
 
 cameraMap = {}
-asyncio.get_event_loop().run_until_complete(webServer())
-asyncio.get_event_loop().run_until_complete(secureRunner())
-asyncio.get_event_loop().run_forever()
+frameAgeMap = {}
+modelPoolMap = {}
+notificationDispatcher = None
+notificationLog = None
+tracer = None
+
+# Only started when run as a script, sbts-benchmark.py loads this file for its functions
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--bind", dest="bind_address", help="Bind address for the control server")
+    parser.add_argument("-p", "--port", dest="server_port", help="Port for the control server")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debug output")
+    parser.add_argument("-i", "--ingest", dest="ingest", choices=["thread", "aiohttp"], default="thread",
+                        help="Read the camera streams with a thread per camera or with aiohttp in the event loop")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, help="Maximum number of cameras processed at the same time")
+    parser.add_argument("-r", "--replay", dest="replay",
+                        help="Replay recorded jpegs from this directory, or from its sub directory named after each camera, then exit")
+    parser.add_argument("--replay-fps", dest="replay_fps", type=float,
+                        help="Frames per second to replay at, as fast as they can be processed when not given")
+    parser.add_argument("--notification-log", dest="notification_log", default="-",
+                        help="File replayed notifications are written to instead of being sent, - for stdout")
+    parser.add_argument("--trace", dest="trace", help="Write Chrome trace events of the processed frames to this file")
+    parser.add_argument("--trace-sample", dest="trace_sample", type=float, default=1.0,
+                        help="Fraction of the frames traced, between 0 and 1")
+    parser.add_argument("--trace-fired", dest="trace_fired", action="store_true",
+                        help="Also trace every frame that fires a notification, whatever the sample rate")
+    parser.add_argument("configFile", help="Path to config file")
+    args = parser.parse_args()
+
+    if args.bind_address == None or args.server_port == None:
+        print("You must supply both a server bind host address and port")
+        sys.exit(1)
+
+    if args.workers is not None and args.workers < 1:
+        print("The number of workers must be at least 1")
+        sys.exit(1)
+
+    if args.replay_fps is not None and args.replay_fps <= 0:
+        print("The replay rate must be more than 0 frames per second")
+        sys.exit(1)
+
+    if args.trace_sample < 0 or args.trace_sample > 1:
+        print("The trace sample rate must be between 0 and 1")
+        sys.exit(1)
+
+    server_bind_address = args.bind_address
+    server_port = args.server_port
+
+    if args.configFile is None:
+        print("Usage: {0} [-d] -b bind address -p port config-json-file".format(sys.argv[0]))
+        sys.exit(1)
+
+    debug = args.debug
+
+    registerCollectedMetrics()
+    notificationDispatcher = NotificationDispatcher()
+
+    if args.replay is not None:
+        notificationLog = NotificationLog(args.notification_log)
+
+    if args.trace is not None:
+        tracer = Tracer(args.trace, args.trace_sample, args.trace_fired)
+    asyncio.get_event_loop().run_until_complete(webServer())
+    asyncio.get_event_loop().run_until_complete(secureRunner())
+    asyncio.get_event_loop().run_forever()
 
-if debug:
-    print("Exiting...")
+    if debug:
+        print("Exiting...")
 
-os._exit(1)
+    os._exit(1)
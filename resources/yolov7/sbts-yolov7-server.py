@@ -4,8 +4,10 @@ import argparse
 import asyncio
 import cv2
 import json
+import struct
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import torch
@@ -16,6 +18,11 @@ from utils.general import (
     check_img_size, non_max_suppression, scale_coords, xyxy2xywh)
 from utils.torch_utils import select_device, time_synchronized
 
+# Binary result format, a header with the number of detections followed by one packed record per detection
+RESULT_MAGIC = b'SBD1'
+RESULT_HEADER = struct.Struct('<4sI')
+RESULT_RECORD = np.dtype([('cls', '<i4'), ('conf', '<f4'), ('box', '<f4', (4,))])
+
 def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
     # Resize and pad image while meeting stride-multiple constraints
     shape = img.shape[:2]  # current shape [height, width]
@@ -48,72 +55,190 @@ def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scale
     img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
     return img, ratio, (dw, dh)
 
+def preprocess(im0):
+    global imgsz
+
+    # Start KIM
+    stride = int(model.stride.max())  # model stride
+    imgsz = check_img_size(imgsz, s=stride)  # check img_size
+    # End KIM
+
+    # Copied from utils/datasets LoadImages
+    # A batch needs every image padded to the same square shape so they can be stacked
+    img = letterbox(im0, new_shape=imgsz, stride=stride, auto=opt.batch_size == 1)[0]
+
+    # Convert
+    img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
+    img = np.ascontiguousarray(img)
+    return img
+
+def decode_and_preprocess(blob_data):
+    nparr = np.frombuffer(blob_data, np.uint8)
+    im0 = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    return preprocess(im0), im0
+
+def detect(imgs, im0s, classes_list):
+    # Run one forward pass and NMS over a batch of preprocessed images, one result array per image
+    # with a row of x, y, w, h, conf, cls for every detection. Each image only keeps the classes in
+    # its entry of classes_list, all of them for None
+    batch = torch.from_numpy(np.stack(imgs)).to(device)
+    batch = batch.half() if half else batch.float()  # uint8 to fp16/32
+    batch /= 255.0  # 0 - 255 to 0.0 - 1.0
+
+    # Inference
+    oldTime = time.time()
+    pred = model(batch, augment=opt.augment)[0]
+
+    # Apply NMS, once for the batch over every class one of its images wants
+    batch_classes = None
+    if all(classes is not None for classes in classes_list):
+        batch_classes = sorted(set().union(*classes_list))
+    pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=batch_classes,
+                               agnostic=opt.agnostic_nms)
+    newTime = time.time()
+
+    if debug:
+        print(">>> Last result for {0} image(s) in {1:.3f}".format(len(imgs), newTime - oldTime))
+
+    results = []
+    for i, det in enumerate(pred):
+        result = np.zeros((0, 6), dtype=np.float32)
+        if det is not None and len(det):
+            # Rescale boxes from img_size to im0 size
+            det[:, :4] = scale_coords(batch.shape[2:], det[:, :4], im0s[i].shape).round()
+
+            # Convert all of the boxes at once on the host rather than box by box
+            det = det.float().cpu().numpy()
+            result = np.concatenate((xyxy2xywh(det[:, :4]), det[:, 4:6]), axis=1)
+
+            # Drop the classes only other images in the batch asked for
+            if classes_list[i] is not None:
+                result = result[np.isin(result[:, 5], classes_list[i])]
+        results.append(result)
+
+    return results
+
+def infer(imgs, im0s, classes_list):
+    # Runs on the inference thread, no_grad only applies to the thread it is entered on
+    with torch.no_grad():
+        return detect(imgs, im0s, classes_list)
+
+async def infer_async(imgs, im0s, classes_list):
+    # One inference thread so frames reach the model one batch at a time while the event loop
+    # carries on reading and preprocessing the next ones
+    return await asyncio.get_event_loop().run_in_executor(inference_executor, infer, imgs, im0s, classes_list)
+
+def result_list(result):
+    return list(zip(names_array[result[:, 5].astype(int)].tolist(), result[:, 4].tolist(), result[:, :4].tolist()))
+
+def result_binary(result):
+    records = np.empty(len(result), dtype=RESULT_RECORD)
+    records['cls'] = result[:, 5]
+    records['conf'] = result[:, 4]
+    records['box'] = result[:, :4]
+    return RESULT_HEADER.pack(RESULT_MAGIC, len(records)) + records.tobytes()
+
+def hello_reply(message):
+    # Clients ask for the result format and the classes they want once per connection, the class names
+    # are sent with the answer so binary results only need to carry class ids
+    try:
+        hello = json.loads(message)['hello']
+    except Exception:
+        hello = {}
+
+    resultFormat = "json"
+    if hello.get('format') == "binary":
+        resultFormat = "binary"
+
+    # Classes the client asked for by name, narrowed further by --classes
+    classes = opt.classes
+    if hello.get('classes') is not None:
+        classes = sorted(set(name_index[name] for name in hello['classes'] if name in name_index))
+        if opt.classes is not None:
+            classes = [c for c in classes if c in opt.classes]
+
+    return {"format": resultFormat, "names": list(names)}, classes
+
+async def batcher():
+    # Collects frames from all of the client connections and runs them through the model together
+    while True:
+        pending = [await batch_queue.get()]
+
+        # Wait up to the batch window for more frames unless a full batch is already waiting
+        if batch_queue.qsize() < opt.batch_size - 1:
+            batch_full.clear()
+            try:
+                await asyncio.wait_for(batch_full.wait(), opt.batch_window / 1000.0)
+            except asyncio.TimeoutError:
+                pass
+
+        while len(pending) < opt.batch_size and not batch_queue.empty():
+            pending.append(batch_queue.get_nowait())
+
+        try:
+            results = await infer_async([request[0] for request in pending], [request[1] for request in pending],
+                                        [request[2] for request in pending])
+        except Exception as e:
+            results = [np.zeros((0, 6), dtype=np.float32) for request in pending]
+            print("Caught exception running batch: {0} {1}".format(type(e).__name__, str(e)))
+
+        for request, result in zip(pending, results):
+            if not request[3].cancelled():
+                request[3].set_result(result)
+
+async def detect_batched(img, im0, classes):
+    future = asyncio.get_event_loop().create_future()
+    batch_queue.put_nowait((img, im0, classes, future))
+    if batch_queue.qsize() >= opt.batch_size - 1:
+        batch_full.set()
+    return await future
+
 async def server_me(websocket, path):
     global source, weights, view_img, save_txt, imgsz, names, device, half, model
 
+    binary = False
+    classes = opt.classes
+
     while True:
         try:
             blob_data = await websocket.recv()
         except websockets.ConnectionClosed:
             break
 
-        new_rlist = []
+        if isinstance(blob_data, str):
+            # Text messages are the handshake, frames are always sent as binary messages
+            reply, classes = hello_reply(blob_data)
+            binary = reply['format'] == "binary"
+            await websocket.send(json.dumps(reply))
+            continue
+
+        result = np.zeros((0, 6), dtype=np.float32)
 
         try:
-            nparr = np.frombuffer(blob_data, np.uint8)
-            im0 = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-            # Start KIM
-            stride = int(model.stride.max())  # model stride
-            imgsz = check_img_size(imgsz, s=stride)  # check img_size
-            # End KIM
-
-            # Copied from utils/datasets LoadImages
-            img = letterbox(im0, new_shape=imgsz, stride=stride)[0]
-
-            # Convert
-            img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
-            img = np.ascontiguousarray(img)
-
-            img = torch.from_numpy(img).to(device)
-            img = img.half() if half else img.float()  # uint8 to fp16/32
-            img /= 255.0  # 0 - 255 to 0.0 - 1.0
-            if img.ndimension() == 3:
-                img = img.unsqueeze(0)
-
-            # Inference
-            oldTime = time.time()
-            pred = model(img, augment=opt.augment)[0]
-
-            # Apply NMS
-            pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes,
-                                       agnostic=opt.agnostic_nms)
-            newTime = time.time()
-
-            for i, det in enumerate(pred):
-                if det is not None and len(det):
-                    # Rescale boxes from img_size to im0 size
-                    det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
-                    for *xyxy, conf, cls in det:
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4))).view(-1).tolist()  # normalized xywh
-                        newPiece = [names[int(cls)], conf.item() , xywh]
-                        new_rlist.append(tuple(newPiece))
+            # Decoding and letterboxing happen on the preprocessing threads
+            img, im0 = await asyncio.get_event_loop().run_in_executor(preprocess_executor, decode_and_preprocess, blob_data)
+
+            if opt.batch_size > 1:
+                result = await detect_batched(img, im0, classes)
+            else:
+                result = (await infer_async([img], [im0], [classes]))[0]
 
         except Exception as e:
-            new_rlist = []
+            result = np.zeros((0, 6), dtype=np.float32)
             print("Caught exception converting image: {0} {1}".format(type(e).__name__, str(e)))
 
         if debug:
-            print("{0}".format(new_rlist))
+            print("{0}".format(result_list(result)))
             print()
 
-        if debug:
-            print(">>> Last result in {0:.3f}".format(newTime - oldTime))
-        await websocket.send(json.dumps(new_rlist))
+        if binary:
+            await websocket.send(result_binary(result))
+        else:
+            await websocket.send(json.dumps(result_list(result)))
 
 
 def initialize():
-    global source, weights, view_img, save_txt, imgsz, names, device, half, model
+    global source, weights, view_img, save_txt, imgsz, names, names_array, name_index, device, half, model
 
     source, weights, view_img, save_txt, imgsz = \
         opt.source, opt.weights, opt.view_img, opt.save_txt, opt.img_size
@@ -130,6 +255,8 @@ def initialize():
 
     # Get names
     names = model.module.names if hasattr(model, 'module') else model.names
+    names_array = np.array(names, dtype=object)
+    name_index = {name: i for i, name in enumerate(names)}
 
     # Run inference
     if device.type != 'cpu':
@@ -149,6 +276,9 @@ if __name__ == '__main__':
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
     parser.add_argument('--update', action='store_true', help='update all models')
+    parser.add_argument('--batch-size', type=int, default=1, help='maximum number of frames from all clients run through the model together')
+    parser.add_argument('--batch-window', type=float, default=5.0, help='milliseconds to wait for more frames to fill a batch')
+    parser.add_argument('--preprocess-workers', type=int, default=2, help='threads decoding and letterboxing frames')
 
     parser.add_argument("-b", "--bind", dest="bind_address", help="Bind address for the server")
     parser.add_argument("-p", "--port", dest="server_port", help="Port for the server")
@@ -164,6 +294,14 @@ if __name__ == '__main__':
     server_port = opt.server_port
     debug = opt.debug
 
+    if opt.batch_size < 1:
+        print("The batch size must be at least 1")
+        sys.exit(1)
+
+    if opt.preprocess_workers < 1:
+        print("There must be at least 1 preprocess worker")
+        sys.exit(1)
+
     print(opt)
 
     with torch.no_grad():
@@ -171,4 +309,15 @@ if __name__ == '__main__':
         start_server = websockets.serve(server_me, server_bind_address, server_port)
 
         asyncio.get_event_loop().run_until_complete(start_server)
+
+        # Frames are decoded on a pool of threads and run through the model on a thread of its own
+        preprocess_executor = ThreadPoolExecutor(max_workers=opt.preprocess_workers)
+        inference_executor = ThreadPoolExecutor(max_workers=1)
+
+        # Frames waiting to be batched and a signal that a full batch is ready
+        batch_queue = asyncio.Queue()
+        batch_full = asyncio.Event()
+        if opt.batch_size > 1:
+            asyncio.ensure_future(batcher())
+
         asyncio.get_event_loop().run_forever()